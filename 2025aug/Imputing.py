@@ -13,6 +13,8 @@
 # * the definition range of atmosphere grids should not be extended past the original parameter spans; and
 # * off-grid intensities should be smoothly "ramped" to (or blended with) a wider grid or a theoretical model, such as the blackbody atmosphere.
 # 
+# Like the rest of this workshop series, this notebook targets PHOEBE 2.4: the atmosphere grids are read from the 2.4 `Passband` attributes (such as `_ck2004_axes` and `_ck2004_photon_grid`), which changed in PHOEBE 2.5.
+# 
 
 # In[1]:
 
@@ -204,6 +206,106 @@ for d, m, s in zip(dirs, fvs.mean(axis=0), fvs.std(axis=0)):
 
 # We note that *all* means are negative, which implies a consistent curvature -- the parameter hyperspace is convex and the estimated value will, on average, be underestimated by ~0.02%. In the figure above we see that the deviation tails are quite long, but they taper off almost completely around $\pm 1\%$. The smallest deviation across-the-board is along effective temperature in 1D. The bottom line, though, is that 1% deviation is rarely ever exceeded, and the actual interpolation acts on a cell that is 1/9-th of the cells used here, which makes any inaccuracy due to non-linearity or choice in the axis sequence inconsequential for all practical purposes.
 
+# The loop above keeps all per-vertex deviations in memory, and it only handles the $\mu=1$ slice in 3-D. To assess the full 4-D grids, including the $\mu$ axis, we need a more economical approach. Multilinear interpolation is separable, so the $D$-dimensional interpolant along axes $(k_1, \dots, k_D)$ is obtained by successive 1-D interpolations along each of these axes, and the 1-D interpolation of the central vertex from its two neighbors along axis $k$ is a weighted sum of two views of the grid, shifted by $\pm 1$ along that axis. Function `interpolate_along()` does just that for all vertices at once, so we can compute each directional interpolant for a slab of the grid in whole-array operations, and we only keep running aggregates per direction: the number of vertices, the sum and the sum of squares of deviations, and a histogram. The grid is processed in slabs along the first axis, with a one-vertex overlap, so memory use does not depend on the grid size. As above, only vertices with a fully defined $3^N$ neighborhood are considered. The report lists directions sorted by the standard deviation, along with the fraction of vertices that deviate by more than 1%.
+
+# In[ ]:
+
+
+import itertools
+
+def interpolate_along(grid, axes, k):
+    """
+    @grid: grid of function values
+    @axes: tuple of axis values
+    @k: axis to interpolate along
+
+    Returns the grid of values interpolated from the two neighbors along
+    axis k; boundary vertices along axis k are set to NaN.
+    """
+
+    a = axes[k]
+    t = ((a[1:-1]-a[:-2])/(a[2:]-a[:-2])).reshape((-1,) + (1,)*(grid.ndim-k-1))
+
+    lo = (slice(None),)*k + (slice(None, -2),)
+    mid = (slice(None),)*k + (slice(1, -1),)
+    hi = (slice(None),)*k + (slice(2, None),)
+
+    rv = np.full_like(grid, np.nan)
+    rv[mid] = grid[lo] + t*(grid[hi]-grid[lo])
+    return rv
+
+
+def nonlinearity_report(axes, grid, names, bins=np.linspace(-1., 1., 26), slab=8):
+    """
+    @axes: N-tuple of axis values that span the first N dimensions of the grid
+    @grid: grid to be assessed
+    @names: N-tuple of axis names
+    @bins: histogram bin edges, in percent
+    @slab: number of vertices along the first axis processed at once
+
+    Prints a per-direction report and returns a dictionary of running
+    aggregates (count, sum, sum of squares, histogram) per direction; the
+    histogram has under- and overflow bins at each end.
+    """
+
+    N = len(axes)
+    dirs = [d for D in range(N, 0, -1) for d in itertools.combinations(range(N), D)]
+    stats = {d: {'count': 0, 'sum': 0., 'sumsq': 0., 'hist': np.zeros(len(bins)+1, dtype=int)} for d in dirs}
+
+    for start in range(1, grid.shape[0]-1, slab):
+        stop = min(start+slab, grid.shape[0]-1)
+        sgrid = grid[start-1:stop+1]
+        saxes = (axes[0][start-1:stop+1],) + tuple(axes[1:])
+
+        # vertices with a fully defined 3^N neighborhood:
+        defined = ~np.isnan(sgrid)
+        for k in range(N):
+            lo = (slice(None),)*k + (slice(None, -2),)
+            mid = (slice(None),)*k + (slice(1, -1),)
+            hi = (slice(None),)*k + (slice(2, None),)
+            shrunk = np.zeros_like(defined)
+            shrunk[mid] = defined[lo] & defined[mid] & defined[hi]
+            defined = shrunk
+
+        interpolants = {(): sgrid}
+        for D in range(1, N+1):
+            for d in itertools.combinations(range(N), D):
+                interpolants[d] = interpolate_along(interpolants[d[:-1]], saxes, d[-1])
+
+        for d in dirs:
+            interps = interpolants[d][defined]
+            devs = 100*(interps-sgrid[defined])/interps
+            stats[d]['count'] += len(devs)
+            stats[d]['sum'] += devs.sum()
+            stats[d]['sumsq'] += (devs**2).sum()
+            stats[d]['hist'] += np.bincount(np.searchsorted(bins, devs, side='right'), minlength=len(bins)+1)
+
+    report = []
+    for d in dirs:
+        s = stats[d]
+        mean = s['sum']/s['count']
+        std = np.sqrt(s['sumsq']/s['count']-mean**2)
+        report.append(('-'.join(names[k] for k in d), mean, std, (s['hist'][0]+s['hist'][-1])/s['count']))
+
+    print('%20s %10s %10s %10s' % ('direction', 'mean [%]', 'std [%]', '>1% [%]'))
+    for name, mean, std, outliers in sorted(report, key=lambda r: r[2]):
+        print('%20s %10.5f %10.5f %10.4f' % (name, mean, std, 100*outliers))
+    print('%d vertices assessed.' % stats[dirs[0]]['count'])
+
+    return stats
+
+
+# Let's assess both the PHOENIX and the ck2004 grids in full 4-D, including the $\mu$ axis:
+
+# In[ ]:
+
+
+print('PHOENIX:')
+_ = nonlinearity_report(axes, ints, names=('teff', 'logg', 'abun', 'mu'))
+print('\nck2004:')
+_ = nonlinearity_report(pb._ck2004_intensity_axes, pb._ck2004_Imu_energy_grid, names=('teff', 'logg', 'abun', 'mu'))
+
+
 # ### Digression: time dependence for interpolation
 # 
 # The interpolation *modifies* the input array of function values, `fv`, to achieve its optimal performance. Because of that, we need to copy the input array as we need to reuse it going forward. We can do that either by passing `copy_data=True` to the interpolator, or by copying the array explicitly before passing it on to the interpolator. It is not obvious which is more meritorious in terms of time cost, so let's check:
@@ -226,6 +328,85 @@ get_ipython().run_line_magic('timeit', 'ndpolate(x, lo, hi, fv, copy_data=False)
 
 # It turns out that the two approaches are equivalent in terms of execution time, so it makes sense to go with the simpler, first option.
 
+# ### Batched interpolation
+# 
+# `ndpolate()` interpolates a single vector at a time, and it rebuilds the knot coordinate matrix `n` on every call. That is fine for imputation, where we call it a few thousand times, but it is prohibitively slow when we need to interpolate intensities for every surface element of a mesh at every time step. Note that the knot matrix is not really needed: the $j$-th vertex lies on the upper knot along axis $k$ whenever the $k$-th bit of $j$ is set, so the interpolation weight along axis $k$ is simply $(x_k - x_{k,\mathrm{lo}})/(x_{k,\mathrm{hi}} - x_{k,\mathrm{lo}})$ for all vertices. That allows us to interpolate an entire array of $M$ vectors at once: we keep the same reduction sequence (from the last axis to the first), but each reduction step now acts on an $(M, 2^{N-k})$ array of function values. The only remaining Python loop is over the $N$ axes.
+# 
+# Function `hypercubes()` does the bookkeeping: for an $(M, N)$ array of vectors it finds the inferior corners of the enclosing hypercubes and gathers the $2^N$ function values in the vertex sequence that `ndpolate()` expects. Vectors that are off the grid are assigned the nearest hypercube along each axis, so they get extrapolated. Trailing dimensions of the grid (such as the last, singleton dimension of atmosphere tables) are carried through.
+
+# In[ ]:
+
+
+def ndpolate_batch(x, lo, hi, fv):
+    """
+    @x: (M, N) array of vectors of interest
+    @lo: (M, N) array of lower knot values
+    @hi: (M, N) array of upper knot values
+    @fv: (M, 2^N, ...) array of function values at knots
+
+    Returns an (M, ...) array of interpolated values. Unlike ndpolate(), fv
+    is not modified in the process.
+    """
+
+    N = x.shape[1]
+    t = (x-lo)/(hi-lo)
+
+    for k in range(N-1, -1, -1):
+        tk = t[:,k].reshape((-1,) + (1,)*(fv.ndim-1))
+        fv = fv[:,:2**k] + tk*(fv[:,2**k:2**(k+1)]-fv[:,:2**k])
+
+    return fv[:,0]
+
+
+def hypercubes(x, axes, grid):
+    """
+    @x: (M, N) array of vectors of interest
+    @axes: N-tuple of axis values
+    @grid: N-dimensional grid of function values (trailing dimensions allowed)
+
+    Returns lo, hi and fv arrays for ndpolate_batch().
+    """
+
+    N = len(axes)
+
+    # inferior corners, clipped so that off-grid vectors are extrapolated:
+    idx = np.column_stack([np.clip(np.searchsorted(axes[k], x[:,k])-1, 0, len(axes[k])-2) for k in range(N)])
+    lo = np.column_stack([axes[k][idx[:,k]] for k in range(N)])
+    hi = np.column_stack([axes[k][idx[:,k]+1] for k in range(N)])
+
+    # vertex j is on the upper knot along axis k if the k-th bit of j is set:
+    shifts = (np.arange(2**N)[:,None] >> np.arange(N)) & 1
+    corners = idx[:,None,:] + shifts
+    fv = grid[tuple(corners[...,k] for k in range(N))]
+
+    return lo, hi, fv
+
+
+# Let's make sure that the batched version reproduces the scalar version, and then compare the time cost for mesh-sized inputs. We draw random vectors across the $\mu=1$ grid; those that fall into hypercubes with undefined vertices will yield NaNs in both versions. Looping over $10^6$ vectors with `ndpolate()` takes a while, so we time the scalar version on (at most) $10^4$ vectors and scale the time linearly.
+
+# In[ ]:
+
+
+import time
+rng = np.random.default_rng(1)
+
+for M in (10**4, 10**5, 10**6):
+    x = np.column_stack([rng.uniform(a[0], a[-1], M) for a in raxes])
+
+    start = time.perf_counter()
+    lo, hi, fv = hypercubes(x, raxes, rgrid)
+    batch_ints = ndpolate_batch(x, lo, hi, fv)
+    batch_time = time.perf_counter()-start
+
+    Ms = min(M, 10**4)
+    start = time.perf_counter()
+    scalar_ints = np.array([ndpolate(x[m], lo[m], hi[m], fv[m], copy_data=True) for m in range(Ms)])
+    scalar_time = (time.perf_counter()-start)*M/Ms
+
+    assert np.allclose(batch_ints[:Ms], scalar_ints, equal_nan=True)
+    print(f'M={M:8d}: scalar {scalar_time:8.3f} s, batched {batch_time:6.3f} s, speedup {scalar_time/batch_time:6.0f}x')
+
+
 # ### Imputing PHOENIX model atmospheres
 
 # The logic behind imputing has been explained in detail above, so we jump right to it here. We will first find all NaN occurrences in the grid, and run the interpolator in all directions for each NaN occurrence. By design, *all* values of $\mu$ will be defined if the combination of $T_\mathrm{eff}$, $\log g$ and $[M/H]$ is defined, so we can impute per $\mu$ instead in the full 4-D space. That pays to do because of the time cost:
@@ -234,6 +415,7 @@ get_ipython().run_line_magic('timeit', 'ndpolate(x, lo, hi, fv, copy_data=False)
 
 
 import time
+raw_ints = ints.copy() # pristine copy for vectorized imputation below
 start = time.perf_counter()
 nantable = np.argwhere(np.isnan(ints[...,0]))
 for entry in nantable:
@@ -246,7 +428,8 @@ for entry in nantable:
     if not np.isnan(interps):
         ints[tuple(entry)][0] = interps
 end = time.perf_counter()
-print(f'It took {end-start:2.2f} seconds to impute the grid in 4-D space.')
+loop_time_4d = end-start
+print(f'It took {loop_time_4d:2.2f} seconds to impute the grid in 4-D space.')
 
 
 # In[11]:
@@ -265,7 +448,78 @@ for i in range(len(axes[-1])): # loop over all mus
         if not np.isnan(interps):
             subgrid[tuple(entry)][0] = interps
 end = time.perf_counter()
-print(f'It took {end-start:2.2f} seconds to impute the grid in the reduced 3-D space.')
+loop_time_3d = end-start
+print(f'It took {loop_time_3d:2.2f} seconds to impute the grid in the reduced 3-D space.')
+
+
+# ### Vectorized imputation
+# 
+# Both loops above call `interpolate_all_directions()` once per NaN vertex, and that is where the time goes. We can turn the problem around: instead of visiting NaN vertices one at a time, we compute each directional interpolant for *all* vertices of the grid at once. Just like in the non-linearity digression above, we obtain the $D$-dimensional interpolant along axes $(k_1, \dots, k_D)$ by successive 1-D interpolations with `interpolate_along()`. Vertices on the grid boundary along axis $k$ lack one of the neighbors, so they get a NaN, just like in the loop. Each $D$-dimensional interpolant reuses the $(D-1)$-dimensional interpolant along its first $D-1$ axes, so all $2^N-1$ directions cost $2^N-1$ whole-grid passes. We then average all defined interpolants for each NaN vertex.
+# 
+# There are three differences w.r.t. the loops above:
+# 
+# * all NaN vertices are imputed simultaneously from the values defined at the start of the pass, so the result does not depend on the order in which NaNs are visited;
+# * passes are repeated until there are no fillable NaNs left, so holes that are wider than a single vertex get filled from the outside in; and
+# * we use all $N \choose D$ combinations of axes in $D$ dimensions, whereas `interpolate_all_directions()` cycles through the axes (which covers all combinations only for $N \leq 3$) and passes the subgrid to `ndpolate()` in C order (which swaps the interpolation weights between axes that are not uniformly spaced).
+# 
+# Consequently, imputed values will differ somewhat from those computed above. Trailing dimensions of the grid that are not covered by `axes` are imputed independently, which is exactly what we need for the per-$\mu$ imputation in the reduced 3-D space.
+
+# In[ ]:
+
+
+def impute_grid(axes, grid, max_passes=None):
+    """
+    @axes: N-tuple of axis values that span the first N dimensions of the grid
+    @grid: grid to be imputed; trailing dimensions are imputed independently
+    @max_passes: maximum number of passes; if None, iterate until no
+                 fillable NaNs remain
+
+    Returns the imputed copy of the grid and the number of passes.
+    """
+
+    N = len(axes)
+    grid = grid.copy()
+    passes = 0
+
+    while max_passes is None or passes < max_passes:
+        nans = np.isnan(grid)
+        total = np.zeros_like(grid)
+        count = np.zeros(grid.shape, dtype=int)
+
+        interpolants = {(): grid}
+        for D in range(1, N+1):
+            for dirs in itertools.combinations(range(N), D):
+                interpolants[dirs] = interpolate_along(interpolants[dirs[:-1]], axes, dirs[-1])
+                defined = nans & ~np.isnan(interpolants[dirs])
+                total[defined] += interpolants[dirs][defined]
+                count += defined
+
+        fillable = count > 0
+        if not fillable.any():
+            break
+
+        grid[fillable] = total[fillable]/count[fillable]
+        passes += 1
+
+    return grid, passes
+
+
+# Let's impute the pristine copy of the grid in both 4-D and reduced 3-D space and compare the time cost with the loops above:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+ints_4d, passes = impute_grid(axes, raw_ints)
+vec_time_4d = time.perf_counter()-start
+print(f'It took {vec_time_4d:2.2f} seconds ({passes} passes) to impute the grid in 4-D space; {loop_time_4d/vec_time_4d:.0f}x faster than the loop.')
+
+start = time.perf_counter()
+ints_3d, passes = impute_grid(axes[:-1], raw_ints)
+vec_time_3d = time.perf_counter()-start
+print(f'It took {vec_time_3d:2.2f} seconds ({passes} passes) to impute the grid in the reduced 3-D space; {loop_time_3d/vec_time_3d:.0f}x faster than the loop.')
+
+print(f'NaN values: {np.isnan(raw_ints).sum()} in the original grid, {np.isnan(ints_4d).sum()} after 4-D and {np.isnan(ints_3d).sum()} after 3-D imputation.')
 
 
 # Replot to see if imputation looks good:
@@ -387,7 +641,7 @@ _ = plt.legend()
 
 def kdtree(axes, atm_grid):
     non_nan_indices = np.argwhere(~np.isnan(atm_grid))
-    non_nan_vertices = np.array([ [axes[i][non_nan_indices[k][i]] for i in range(len(axes))] for k in range(len(non_nan_indices))])
+    non_nan_vertices = np.column_stack([axes[i][non_nan_indices[:,i]] for i in range(len(axes))])
     return spatial.KDTree(non_nan_vertices), non_nan_indices
 
 
@@ -402,6 +656,86 @@ d, i = tree.query(remap((3250, 4.2, 0.09), blending_region=blending_region, offs
 print('nearest neighbor ldint value: %f' % (ldint_grid[tuple(indices[i])]))
 
 
+# The tree depends only on the passband, the atmosphere and the remapping of the axes, yet building it is the dominant startup cost when `ldint_mode='nearest'` queries are farmed out to many worker processes. We can thus build the tree once, store it on disk, and have each process load it lazily on first use. k-D trees pickle their internal node arrays, so loading a tree does not rebuild it. The file name carries a hash of everything the tree depends on (the passband timestamp, the blending region, the offsets, the axes and the grid), so a change in any of them results in a new tree. Along with each pickle we store its SHA-256 checksum and verify it before unpickling, so that a truncated or partially written file is rebuilt rather than loaded. Keep in mind that unpickling can execute arbitrary code: the checksum protects against corruption, not tampering, so the cache directory should only ever contain files written by `get_ldint_tree()`.
+
+# In[ ]:
+
+
+import os
+import pickle
+import hashlib
+
+ldint_trees = {}
+
+def get_ldint_tree(pb, atm, axes, atm_grid, blending_region, offsets, cache_dir='.'):
+    """
+    @pb: passband
+    @atm: model atmosphere
+    @axes: remapped axes
+    @atm_grid: integrated limb darkening grid
+    @blending_region, offsets: remapping of the axes, see remap()
+    @cache_dir: directory where k-D trees are stored; only point it to a
+        directory with trusted content, as the trees are unpickled
+
+    Returns the k-D tree and the non-null indices for the given passband,
+    atmosphere and remapping; the tree is loaded from the cache if it is
+    valid, and built and stored otherwise.
+    """
+
+    params = (str(getattr(pb, 'timestamp', '')), tuple(float(b) for b in blending_region), tuple(float(o) for o in offsets))
+    digest = hashlib.sha1(repr(params).encode())
+    for array in list(axes) + [atm_grid]:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    key = f'{pb.pbset}_{pb.pbname}_{atm}_ldint_tree_{digest.hexdigest()[:16]}'
+
+    if key in ldint_trees:
+        return ldint_trees[key]
+
+    fname = os.path.join(cache_dir, f'{key}.pickle')
+    if os.path.exists(fname) and os.path.exists(f'{fname}.sha256'):
+        with open(fname, 'rb') as f:
+            data = f.read()
+        with open(f'{fname}.sha256') as f:
+            checksum = f.read().strip()
+        if hashlib.sha256(data).hexdigest() == checksum:
+            ldint_trees[key] = pickle.loads(data)
+            return ldint_trees[key]
+        print(f'checksum mismatch for {fname}, rebuilding the tree.')
+
+    ldint_trees[key] = kdtree(axes, atm_grid)
+
+    # write to process-specific temporary files first, so that concurrent
+    # workers never read a partially written tree:
+    data = pickle.dumps(ldint_trees[key])
+    for path, content, mode in ((fname, data, 'wb'), (f'{fname}.sha256', hashlib.sha256(data).hexdigest(), 'w')):
+        with open(f'{path}.{os.getpid()}.tmp', mode) as f:
+            f.write(content)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    return ldint_trees[key]
+
+
+# Let's compare the time it takes to build the tree, load it from disk (as a fresh worker process would), and retrieve it once it is loaded:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+tree, indices = kdtree(naxes, ldint_grid)
+print(f'building the tree: {time.perf_counter()-start:.4f} s')
+
+_ = get_ldint_tree(pb, 'phoenix', naxes, ldint_grid, blending_region, offsets)
+ldint_trees.clear()
+
+start = time.perf_counter()
+tree, indices = get_ldint_tree(pb, 'phoenix', naxes, ldint_grid, blending_region, offsets)
+print(f'loading the tree: {time.perf_counter()-start:.4f} s')
+
+start = time.perf_counter()
+tree, indices = get_ldint_tree(pb, 'phoenix', naxes, ldint_grid, blending_region, offsets)
+print(f'retrieving the loaded tree: {time.perf_counter()-start:.6f} s')
+
+
 # ### Computing the blended intensity
 # 
 # Blended emergent intensity can in general be written as:
@@ -430,16 +764,78 @@ print('nearest neighbor ldint value: %f' % (ldint_grid[tuple(indices[i])]))
 #     Here $\alpha(d)$ is the blending parameter defined above.
 # * average all $I_\mathrm{blend}(\mathbf v)$ from all hypercubes.
 # 
-# For compute time efficiency, it proves useful to assemble an array of inferior corners of fully defined hypercubes across the entire grid ahead of time; we will use this array to lookup the nearest fully defined hypercube (or a set of hypercubes) for each vector that is off-grid.
+# For compute time efficiency, it proves useful to assemble an array of inferior corners of fully defined hypercubes across the entire grid ahead of time; we will use this array to lookup the nearest fully defined hypercube (or a set of hypercubes) for each vector that is off-grid. Searching the array on every query would still cost $\mathcal O(n)$ for $n$ hypercubes, so we go one step further and precompute a lattice index: for every possible inferior corner of the vector of interest, including the ones that are off the grid (`np.searchsorted()` places all off-grid values one step beyond the grid edge), we store the list of nearest fully defined hypercubes. The distance is measured in the number of lattice steps and all ties are kept. To build the index, we put the inferior corners in a k-D tree with the Manhattan metric and query it with all lattice points at once, which costs $\mathcal O(\log n)$ per lattice point. The index is cached per passband, atmosphere and pattern of undefined vertices in the grid, so each lookup is a single array access, and a different grid (for example, one that has been imputed in the meantime) gets its own index.
 
 # In[19]:
 
 
-ics = np.array([(i, j, k) for i in range(0,len(raxes[0])-1) for j in range(0,len(raxes[1])-1) for k in range(0,len(raxes[2])-1) if ~np.any(np.isnan(ints[i:i+2,j:j+2,k:k+2]))])
+def lattice_index(grid, N=3):
+    """
+    @grid: atmosphere grid; the first N dimensions span the interpolation axes
+    @N: number of interpolation axes
+
+    Returns an array of inferior corners of fully defined hypercubes, `ics`,
+    and a dense lattice index, `nearest`: nearest[tuple(entry+1)] holds the
+    indices into `ics` of all fully defined hypercubes nearest to the
+    inferior corner `entry`, where entry[k] ranges from -1 to len(axes[k])-1.
+    """
+
+    shape = grid.shape[:N]
+    defined = ~np.isnan(grid).reshape(shape + (-1,)).any(axis=-1)
+
+    # a hypercube is fully defined if all of its 2^N vertices are defined:
+    full = np.ones(tuple(n-1 for n in shape), dtype=bool)
+    for shift in itertools.product((0, 1), repeat=N):
+        full &= defined[tuple(slice(s, s+n-1) for s, n in zip(shift, shape))]
+    ics = np.argwhere(full)
+
+    # all possible inferior corners, including the off-grid ones:
+    lattice = np.indices(tuple(n+1 for n in shape)).reshape(N, -1).T - 1
+
+    # distances are integer numbers of lattice steps, so all ties lie within
+    # half a step of the nearest distance:
+    tree = spatial.cKDTree(ics)
+    sep, _ = tree.query(lattice, p=1)
+    nearest = np.empty(len(lattice), dtype=object)
+    nearest[:] = [np.array(corners, dtype=int) for corners in tree.query_ball_point(lattice, sep+0.5, p=1, return_sorted=True)]
+
+    return ics, nearest.reshape(tuple(n+1 for n in shape))
+
+
+lattice_indices = {}
+
+def get_lattice_index(pb, atm, grid, N=3):
+    # the index only depends on which vertices are undefined:
+    key = (pb.pbset, pb.pbname, atm, grid.shape, N, hashlib.sha1(np.isnan(grid).tobytes()).hexdigest())
+    if key not in lattice_indices:
+        lattice_indices[key] = lattice_index(grid, N)
+    return lattice_indices[key]
+
+
+ics, nearest = get_lattice_index(pb, 'phoenix', ints)
 print('%d inferior corners of fully defined hypercubes found.' % (len(ics)))
 
 
-# Finally, define blending. The function takes the vector of interest `v`, remapped axes `naxes`, the atmosphere grid `atm_grid`, the integrated limb darkening grid `ldint_grid`, $\mathcal L_\mathrm{int}$ extrapolation mode `ldint_mode`, which can be `extrapolate` or `nearest`, and an optional debugging flag `debug` that cranks up verbosity. The logic of the function follows the prescription above. A few remarks:
+# Let's make sure that the lattice index yields the same hypercubes as the brute-force search over all inferior corners, and compare the lookup times:
+
+# In[ ]:
+
+
+def brute_force_corners(entry):
+    sep = (np.abs(ics-entry)).sum(axis=1)
+    return np.argwhere(sep == sep.min()).flatten()
+
+for entry in np.indices(nearest.shape).reshape(3, -1).T[::7]-1:
+    assert np.array_equal(brute_force_corners(entry), nearest[tuple(entry+1)])
+
+entry = np.array((-1, 4, 3))
+print('brute-force lookup:')
+get_ipython().run_line_magic('timeit', 'brute_force_corners(entry)')
+print('lattice index lookup:')
+get_ipython().run_line_magic('timeit', 'nearest[tuple(entry+1)]')
+
+
+# Finally, define blending. The function takes the vector of interest `v`, remapped axes `naxes`, the atmosphere grid `atm_grid`, the integrated limb darkening grid `ldint_grid`, the lattice index `index` returned by `get_lattice_index()`, $\mathcal L_\mathrm{int}$ extrapolation mode `ldint_mode`, which can be `extrapolate` or `nearest`, and an optional debugging flag `debug` that cranks up verbosity. The logic of the function follows the prescription above. A few remarks:
 # 
 # * the function calculates $\log I$ instead of $I$ under the hood;
 # * hypercubes are uniquely identified by their inferior corner: the corner in the hypercube at the lowermost values of axes;
@@ -448,7 +844,8 @@ print('%d inferior corners of fully defined hypercubes found.' % (len(ics)))
 # In[20]:
 
 
-def blend(v, naxes, atm_grid, ldint_grid, ldint_mode='interpolate', debug=False):
+def blend(v, naxes, atm_grid, ldint_grid, index, ldint_mode='interpolate', debug=False):
+    ics, nearest = index
     nv = remap(v, blending_region=blending_region, offsets=offsets)
     if debug:
         print('vector:', v, '\nnormalized vector:', nv)
@@ -458,10 +855,9 @@ def blend(v, naxes, atm_grid, ldint_grid, ldint_mode='interpolate', debug=False)
     if debug:
         print('coordinates of the inferior corner:', entry)
 
-    # get the inferior corners of all nearest fully defined hypercubes; this
-    # is all integer math so we can compare with == instead of np.isclose().
-    sep = (np.abs(ics-np.array(entry))).sum(axis=1)
-    corners = np.argwhere(sep == sep.min()).flatten()
+    # get the inferior corners of all nearest fully defined hypercubes from
+    # the lattice index:
+    corners = nearest[tuple(np.array(entry)+1)]
     if debug:
         print('%d fully defined adjacent hypercube(s) found.' % len(corners))
         for i, corner in enumerate(corners):
@@ -552,16 +948,16 @@ def blend(v, naxes, atm_grid, ldint_grid, ldint_mode='interpolate', debug=False)
 # In[21]:
 
 
-def log_bb_intensity(v, naxes, ldint_grid, ldint_mode='extrapolate', ldint_tree=None, ldint_indices=None):
+def log_bb_intensity(v, naxes, ldint_grid, index, ldint_mode='extrapolate', ldint_tree=None, ldint_indices=None):
+    ics, nearest = index
     nv = remap(v, blending_region=blending_region, offsets=offsets)
     
     # coordinates of the inferior corner:
     entry = [np.searchsorted(naxes[k], nv[k])-1 for k in range(len(naxes))]
 
-    # get the inferior corners of all nearest fully defined hypercubes; this
-    # is all integer math so we can compare with == instead of np.isclose().
-    sep = (np.abs(ics-np.array(entry))).sum(axis=1)
-    corners = np.argwhere(sep == sep.min()).flatten()
+    # get the inferior corners of all nearest fully defined hypercubes from
+    # the lattice index:
+    corners = nearest[tuple(np.array(entry)+1)]
 
     if ldint_mode == 'nearest':
         if ldint_tree is None or ldint_indices is None:
@@ -610,13 +1006,18 @@ ldint_grid = pb._ck2004_ldint_energy_grid
 
 naxes = remap(raxes, blending_region=blending_region, offsets=offsets)
 
+# lattice index of the nearest fully defined hypercubes:
+index = get_lattice_index(pb, 'ck2004', rgrid)
+
 # initialize the nearest-neighbor search:
-ldint_tree, ldint_indices = kdtree(naxes, ldint_grid)
+ldint_tree, ldint_indices = get_ldint_tree(pb, 'ck2004', naxes, ldint_grid, blending_region, offsets)
 
+start = time.perf_counter()
 for i, teff in enumerate(teffs):
-    ints[i] = blend((teff, logg, abun), naxes, rgrid, ldint_grid)
-    bbints[i] = log_bb_intensity((teff, logg, abun), naxes, ldint_grid, 'extrapolate')
-    bbints_nearest[i] = log_bb_intensity((teff, logg, abun), naxes, ldint_grid, 'nearest', ldint_tree=ldint_tree, ldint_indices=ldint_indices)
+    ints[i] = blend((teff, logg, abun), naxes, rgrid, ldint_grid, index)
+    bbints[i] = log_bb_intensity((teff, logg, abun), naxes, ldint_grid, index, 'extrapolate')
+    bbints_nearest[i] = log_bb_intensity((teff, logg, abun), naxes, ldint_grid, index, 'nearest', ldint_tree=ldint_tree, ldint_indices=ldint_indices)
+loop_time = time.perf_counter()-start
 
 plt.figure(figsize=(16,6))
 plt.xlabel('Temperature [K]')
@@ -629,6 +1030,557 @@ plt.plot(teffs, ints, 'b-', lw=2, label='blended response')
 _ = plt.legend(loc='lower right')
 
 
+# ### Vectorized blending
+# 
+# Both `blend()` and `log_bb_intensity()` handle a single vector at a time, and the sweep above calls them 1500 times each. On a real mesh we need blended intensities for every surface element that is off the grid, so we want an array-in/array-out version. The key observation is that all vectors that share the same inferior corner (and thus the same entry in the lattice index) are blended against the same set of nearest fully defined hypercubes. We thus group the vectors by their lattice index entry, expand each vector into (vector, hypercube) pairs, and then run every step of the prescription above on all pairs at once:
+# 
+# * the extrapolated $\mathcal L_\mathrm{int}$ and the extrapolated model atmosphere intensity are computed with `ndpolate_batch()`; alternatively, $\mathcal L_\mathrm{int}$ is adopted from the nearest neighbor by querying the k-D tree with all vectors at once;
+# * the nearest hypercube vertex is found independently along each axis (the squared distance to a vertex is a sum of per-axis terms), and the distance vector is projected onto the hypercube shift when the hypercube is adjacent;
+# * the blending parameter is computed by `bf()`, which already operates on arrays;
+# * per-pair intensities are averaged per vector with `np.bincount()`.
+# 
+# The function returns both the blended intensities and the blackbody response, which correspond to `blend()` and `log_bb_intensity()`, respectively.
+
+# In[ ]:
+
+
+def blend_batch(pb, vs, naxes, atm_grid, ldint_grid, index, blending_region, offsets, ldint_mode='extrapolate', ldint_tree=None, ldint_indices=None, atm='ck2004', func='sigmoid', tau=15, offset=0.5):
+    """
+    @pb: passband
+    @vs: (M, N) array of vectors of interest
+    @naxes: remapped axes
+    @atm_grid: model atmosphere grid
+    @ldint_grid: integrated limb darkening grid
+    @index: lattice index of the atmosphere grid, see get_lattice_index()
+    @blending_region, offsets: remapping of the axes, see remap()
+    @ldint_mode: 'extrapolate' or 'nearest'
+    @ldint_tree, ldint_indices: k-D tree and indices for the 'nearest' mode
+    @atm: model atmosphere used for vectors within the grid
+    @func, tau, offset: blending function parameters, see bf()
+
+    Returns two (M,) arrays: blended intensities and blackbody intensities
+    (both logarithmic).
+    """
+
+    if ldint_mode not in ('extrapolate', 'nearest'):
+        raise ValueError(f'ldint_mode={ldint_mode} is not supported.')
+    if ldint_mode == 'nearest' and (ldint_tree is None or ldint_indices is None):
+        raise ValueError('ldint_mode=nearest requires ldint_tree and ldint_indices.')
+
+    N = len(naxes)
+    ics, nearest = index
+    vs = np.asarray(vs, dtype=float)
+    nvs = np.column_stack(remap(vs.T, blending_region=blending_region, offsets=offsets))
+
+    # coordinates of the inferior corners:
+    entries = np.column_stack([np.searchsorted(naxes[k], nvs[:,k])-1 for k in range(N)])
+
+    # group vectors by their lattice index entry and expand them into
+    # (vector, hypercube) pairs:
+    cells, inverse = np.unique(np.ravel_multi_index((entries+1).T, nearest.shape), return_inverse=True)
+    cell_corners = [nearest.flat[cell] for cell in cells]
+    cell_counts = np.array([len(c) for c in cell_corners])
+    cell_starts = np.cumsum(cell_counts)-cell_counts
+    counts = cell_counts[inverse.ravel()]
+    pts = np.repeat(np.arange(len(vs)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)
+    corners = ics[np.concatenate(cell_corners)[np.repeat(cell_starts[inverse.ravel()], counts) + local]]
+
+    nv = nvs[pts]
+    lo = np.column_stack([naxes[k][corners[:,k]] for k in range(N)])
+    hi = np.column_stack([naxes[k][corners[:,k]+1] for k in range(N)])
+    shifts = (np.arange(2**N)[:,None] >> np.arange(N)) & 1
+    vertices = tuple((corners[:,None,:] + shifts)[...,k] for k in range(N))
+
+    # distance vectors to the nearest vertices, projected for adjacent hypercubes:
+    distance_vectors = np.where(np.abs(nv-lo) <= np.abs(nv-hi), nv-lo, nv-hi)
+    shift = entries[pts] != corners
+    adjacent = shift.sum(axis=1) == 1
+    distance_vectors[adjacent] *= shift[adjacent]
+    distances = np.sqrt((distance_vectors**2).sum(axis=1))
+
+    # ldint, either extrapolated or adopted from the nearest neighbor:
+    if ldint_mode == 'extrapolate':
+        ldints = ndpolate_batch(nv, lo, hi, ldint_grid[vertices])[:,0]
+    else:
+        d, i = ldint_tree.query(nvs)
+        ldints = ldint_grid[tuple(ldint_indices[i].T)][pts]
+
+    bbints = pb._log10_Inorm_bb_energy(vs[pts,0]) - np.log10(ldints)
+
+    # extrapolated model atmosphere intensities and blending:
+    atmints = ndpolate_batch(nv, lo, hi, atm_grid[vertices])[:,0]
+    alphas = bf(distances, func=func, tau=tau, offset=offset)
+    blints = np.where(distances > 1, bbints, (1-alphas)*bbints + alphas*atmints)
+
+    # vectors within the grid:
+    inside = shift.sum(axis=1) == 0
+    if inside.any():
+        blints[inside] = np.log10(pb.Inorm(vs[pts[inside],0], vs[pts[inside],1], vs[pts[inside],2], atm=atm))
+
+    # average over all hypercubes per vector:
+    return np.bincount(pts, weights=blints)/counts, np.bincount(pts, weights=bbints)/counts
+
+
+# Let's run the same temperature sweep through `blend_batch()`, make sure that we get the same results as with the loop, and compare the time cost. We also compute the blended response when $\mathcal L_\mathrm{int}$ is adopted from the nearest neighbor:
+
+# In[ ]:
+
+
+vs = np.column_stack((teffs, np.full_like(teffs, logg), np.full_like(teffs, abun)))
+
+start = time.perf_counter()
+blints, bbints_batch = blend_batch(pb, vs, naxes, rgrid, ldint_grid, index, blending_region, offsets, ldint_mode='extrapolate')
+blints_nearest, bbints_nearest_batch = blend_batch(pb, vs, naxes, rgrid, ldint_grid, index, blending_region, offsets, ldint_mode='nearest', ldint_tree=ldint_tree, ldint_indices=ldint_indices)
+batch_time = time.perf_counter()-start
+
+assert np.allclose(blints, ints) and np.allclose(bbints_batch, bbints) and np.allclose(bbints_nearest_batch, bbints_nearest)
+print(f'loop: {loop_time:.3f} s, vectorized: {batch_time:.3f} s; {loop_time/batch_time:.0f}x faster.')
+
+plt.figure(figsize=(16,6))
+plt.xlabel('Temperature [K]')
+plt.ylabel('Normal intensity in Johnson:V')
+plt.gca().axvline(3500, ls='--')
+plt.gca().axvline(3500-blending_region[0], ls='--', label='blending region')
+plt.plot(teffs, blints, 'b-', lw=2, label='blended response (extrapolated ldint)')
+plt.plot(teffs, blints_nearest, 'r-', lw=2, label='blended response (nearest ldint)')
+_ = plt.legend(loc='lower right')
+
+
+# ### Precomputed extended grids
+# 
+# Blending is relatively expensive even when vectorized: every off-grid vector needs the lattice index lookup, two extrapolations and the blending function. However, for a given passband, atmosphere and choice of blending parameters, the blended intensity is a fixed function of atmospheric parameters, so we can compute it once on an *extended* grid and store it on disk. We pad each axis with knots that cover the blending region (1 unit in remapped coordinates) and reach `extent` units beyond the grid edge, well into the blackbody regime. The knots are spaced by `1/knots_per_unit` of the blending region so that the sigmoid ramp is well sampled. Interior vertices that are undefined in the original grid get blended values as well. Off-grid lookups then become plain on-grid interpolation with `ndpolate_batch()`.
+# 
+# The extended grid depends on the atmosphere and $\mathcal L_\mathrm{int}$ grids, the remapping of the axes (blending region and offsets), the blending function and its parameters, and the $\mathcal L_\mathrm{int}$ mode. We hash all of these (and the passband timestamp) into the name of the cached file, so a change in any of them results in a new grid, while going back to a previous choice loads the grid that is already stored.
+
+# In[ ]:
+
+
+def extended_grid(pb, atm, axes, atm_grid, ldint_grid, blending_region, offsets, ldint_mode='extrapolate', ldint_tree=None, ldint_indices=None,
+                  func='sigmoid', tau=15, offset=0.5, extent=2, knots_per_unit=20, cache_dir='.'):
+    """
+    @pb: passband
+    @atm: model atmosphere
+    @axes: axes of the model atmosphere grid
+    @atm_grid, ldint_grid, ldint_mode, ldint_tree, ldint_indices: see blend_batch()
+    @blending_region, offsets: remapping of the axes, see remap()
+    @func, tau, offset: blending function parameters, see bf()
+    @extent: extent of the padding beyond the grid edge, in blending region units
+    @knots_per_unit: number of padding knots per blending region unit
+    @cache_dir: directory where extended grids are stored
+
+    Returns the extended axes and the extended grid of blended (logarithmic)
+    intensities.
+    """
+
+    N = len(axes)
+    params = {
+        'timestamp': str(getattr(pb, 'timestamp', '')),
+        'blending_region': tuple(float(b) for b in blending_region),
+        'offsets': tuple(float(o) for o in offsets),
+        'ldint_mode': ldint_mode,
+        'func': func,
+        'tau': tau,
+        'offset': offset,
+        'extent': extent,
+        'knots_per_unit': knots_per_unit,
+    }
+
+    # hash all inputs, including the contents of the axes and the grids:
+    key = hashlib.sha1(repr(sorted(params.items())).encode())
+    for array in list(axes) + [atm_grid, ldint_grid]:
+        key.update(np.ascontiguousarray(array).tobytes())
+
+    fname = os.path.join(cache_dir, f'{pb.pbset}_{pb.pbname}_{atm}_extended_{key.hexdigest()[:16]}.npz')
+    if os.path.exists(fname):
+        with np.load(fname) as cached:
+            return tuple(cached[f'axis{k}'] for k in range(N)), cached['grid']
+
+    ramp = np.linspace(0, extent, int(extent*knots_per_unit)+1)[1:]
+    eaxes = tuple(np.concatenate((axes[k][0]-blending_region[k]*ramp[::-1], axes[k], axes[k][-1]+blending_region[k]*ramp)) for k in range(N))
+    naxes = remap(axes, blending_region=blending_region, offsets=offsets)
+    index = get_lattice_index(pb, atm, atm_grid, N)
+
+    vertices = np.stack(np.meshgrid(*eaxes, indexing='ij'), axis=-1).reshape(-1, N)
+    grid = np.empty(len(vertices))
+    for start in range(0, len(vertices), 100000):
+        grid[start:start+100000], _ = blend_batch(pb, vertices[start:start+100000], naxes, atm_grid, ldint_grid, index, blending_region, offsets, ldint_mode, ldint_tree, ldint_indices, atm=atm, func=func, tau=tau, offset=offset)
+    grid = grid.reshape([len(a) for a in eaxes] + [1])
+
+    np.savez(fname, grid=grid, **{f'axis{k}': eaxes[k] for k in range(N)})
+    return eaxes, grid
+
+
+# Let's build the extended ck2004 grid, load it back from the cache, and then change the blending function steepness to see the grid rebuilt:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+eaxes, egrid = extended_grid(pb, 'ck2004', raxes, rgrid, ldint_grid, blending_region, offsets)
+print(f'building the extended grid took {time.perf_counter()-start:.2f} seconds; grid shape: {egrid.shape}')
+
+start = time.perf_counter()
+eaxes, egrid = extended_grid(pb, 'ck2004', raxes, rgrid, ldint_grid, blending_region, offsets)
+print(f'loading the extended grid took {time.perf_counter()-start:.2f} seconds')
+
+start = time.perf_counter()
+_ = extended_grid(pb, 'ck2004', raxes, rgrid, ldint_grid, blending_region, offsets, tau=20)
+print(f'rebuilding the extended grid for tau=20 took {time.perf_counter()-start:.2f} seconds')
+
+
+# The temperature sweep is now a plain interpolation on the extended grid. The only differences w.r.t. `blend_batch()` are due to linear interpolation of the ramp between padding knots:
+
+# In[ ]:
+
+
+eaxes, egrid = extended_grid(pb, 'ck2004', raxes, rgrid, ldint_grid, blending_region, offsets)
+
+start = time.perf_counter()
+_ = blend_batch(pb, vs, naxes, rgrid, ldint_grid, index, blending_region, offsets)
+blend_time = time.perf_counter()-start
+
+start = time.perf_counter()
+eints = ndpolate_batch(vs, *hypercubes(vs, eaxes, egrid))[:,0]
+lookup_time = time.perf_counter()-start
+
+print(f'blend_batch(): {blend_time:.4f} s, extended grid lookup: {lookup_time:.4f} s')
+print(f'maximum deviation from blend_batch(): {np.abs(eints-blints).max():.5f} dex')
+
+
+# ### Sharing atmosphere grids across processes
+# 
+# Passbands carry large dense tables: intensities, specific intensities, limb darkening coefficients and integrals for each atmosphere, in both energy- and photon-weighted flavors. When we fit a model with a pool of worker processes, each worker loads its own copy of the entire passband, even though most of these tables are never used. A better option is to store the tables uncompressed on disk, one file per table, and open them with `np.memmap` (via `np.load(..., mmap_mode='r')`). Opening a memory-mapped table costs next to nothing; the operating system reads only the pages that are actually accessed, and all workers share these pages through the OS file cache. The functions in this notebook operate on arrays, so they work on memory-mapped tables as they are.
+# 
+# We first export all passband tables to a directory: each grid is stored as a `.npy` file and each set of axes as a (small) `.npz` file.
+
+# In[ ]:
+
+
+def export_tables(pb, path):
+    """
+    @pb: passband
+    @path: directory where the tables are stored
+    """
+
+    os.makedirs(path, exist_ok=True)
+    for name, value in vars(pb).items():
+        if name.endswith('_grid') and isinstance(value, np.ndarray):
+            np.save(os.path.join(path, f'{name}.npy'), value)
+        elif name.endswith('_axes'):
+            np.savez(os.path.join(path, f'{name}.npz'), *value)
+
+
+def load_tables(path, atms):
+    """
+    @path: directory with the exported tables
+    @atms: list of model atmospheres to load
+
+    Returns a dictionary of memory-mapped grids and axes of the requested
+    model atmospheres; tables of other atmospheres are never touched.
+    """
+
+    tables = {}
+    for fname in sorted(os.listdir(path)):
+        name, ext = os.path.splitext(fname)
+        if not any(name.startswith(f'_{atm}_') for atm in atms):
+            continue
+        if ext == '.npy':
+            tables[name] = np.load(os.path.join(path, fname), mmap_mode='r')
+        elif ext == '.npz':
+            with np.load(os.path.join(path, fname)) as axes:
+                tables[name] = tuple(axes[f'arr_{k}'] for k in range(len(axes.files)))
+    return tables
+
+
+def referenced_atms(b):
+    """
+    @b: bundle
+
+    Returns a sorted list of model atmospheres referenced by the bundle,
+    either as `atm` in compute options or as the limb darkening source
+    (`ld_coeffs_source`) of datasets with `ld_mode='lookup'`. As in the
+    backend, 'auto' resolves to ck2004 for atmospheres without limb
+    darkening tables and to `atm` otherwise.
+    """
+
+    atms = {p.get_value() for p in b.filter(qualifier='atm', context='compute').to_list()}
+    for p in b.filter(qualifier='ld_mode', context='dataset', value='lookup').to_list():
+        source = b.get_value(qualifier='ld_coeffs_source', dataset=p.dataset, component=p.component, context='dataset', check_visible=False)
+        if source == 'auto':
+            component_atms = {q.get_value() for q in b.filter(qualifier='atm', component=p.component, context='compute').to_list()}
+            atms |= {'ck2004' if atm in ('blackbody', 'extern_atmx', 'extern_planckint') else atm for atm in component_atms}
+        else:
+            atms.add(source)
+    return sorted(atms)
+
+
+# Let's export the Johnson:V tables and load only the ones needed by a default binary with phoenix atmospheres:
+
+# In[ ]:
+
+
+export_tables(pb, 'Johnson_V_tables')
+
+b = phoebe.default_binary()
+b.add_dataset('lc', compute_phases=phoebe.linspace(0, 1, 101), passband='Johnson:V')
+b.set_value_all('atm', 'phoenix')
+print('referenced atmospheres:', referenced_atms(b))
+
+start = time.perf_counter()
+tables = load_tables('Johnson_V_tables', referenced_atms(b))
+print(f'memory-mapping {len(tables)} tables took {time.perf_counter()-start:.4f} seconds:')
+for name in tables:
+    print(f'  {name}')
+
+
+# To measure the load time and the peak resident memory (RSS) that a fresh worker pays, we run each variant in a separate Python process. In both cases the worker imports phoebe, gets hold of the phoenix specific intensity grid and touches its $\mu=1$ slice. Note that the RSS of a memory-mapped worker counts the file pages it touched, but these pages are shared by all workers rather than duplicated in each one.
+
+# In[ ]:
+
+
+import subprocess
+import sys
+
+worker = """
+import sys, time, resource
+import numpy as np
+import phoebe
+
+scale = 1 if sys.platform == 'darwin' else 1024
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+start = time.perf_counter()
+{load}
+np.nanmean(grid[...,-1,:])
+print(time.perf_counter()-start, rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale)
+"""
+
+loads = {
+    'full passband': "grid = phoebe.get_passband('Johnson:V')._phoenix_Imu_energy_grid",
+    'memory-mapped': "grid = np.load('Johnson_V_tables/_phoenix_Imu_energy_grid.npy', mmap_mode='r')",
+}
+
+for label, load in loads.items():
+    out = subprocess.run([sys.executable, '-c', worker.format(load=load)], capture_output=True, text=True).stdout.split()
+    load_time, rss_import, rss_peak = float(out[-3]), int(out[-2]), int(out[-1])
+    print(f'{label:>14s}: load time {load_time:.3f} s, peak RSS {rss_peak/2**20:.0f} MB ({(rss_peak-rss_import)/2**20:.0f} MB on top of the phoebe import)')
+
+
+# ### Reusable interpolators for fixed meshes
+# 
+# Every call to `pb.Inorm()` or `pb.Imu()` searches the axes, gathers the hypercube corners and computes interpolation weights anew. Between solver iterations that only change `pblum` or `l3`, however, mesh values of $T_\mathrm{eff}$, $\log g$ and $[M/H]$ remain the same, and so do the corners and the weights. Multilinear interpolation can be written as a weighted sum over the $2^N$ corners, where the weight of each corner is a product of $t_k$ or $1-t_k$ along each axis, depending on whether the corner is on the upper or the lower knot. So we compute corner indices and weights once per mesh, and evaluating any grid that shares the same axes (any passband, energy- or photon-weighted, normal or specific intensities) becomes a single gather-multiply-sum. Specific intensities are then interpolated in $\mu$ for each element. The interpolator also detects unchanged inputs when updated, and it caches results per grid. Note that vectors off the grid are extrapolated rather than blended, and that grids are assumed not to be modified in place.
+
+# In[ ]:
+
+
+class MeshInterpolator:
+    """
+    Multilinear interpolator for a fixed set of atmospheric parameter vectors.
+    """
+
+    def __init__(self, axes, *values):
+        """
+        @axes: N-tuple of axis values
+        @values: N arrays of atmospheric parameters (such as teffs, loggs, abuns)
+        """
+
+        self.axes = axes
+        self.values = None
+        self.update(*values)
+
+    def update(self, *values):
+        """
+        @values: N arrays of atmospheric parameters
+
+        Recomputes corners and weights unless the values are unchanged;
+        returns True if they were recomputed.
+        """
+
+        if self.values is not None and all(np.array_equal(v, w) for v, w in zip(self.values, values)):
+            return False
+
+        N = len(self.axes)
+        self.values = tuple(np.array(v, dtype=float) for v in values)
+        x = np.column_stack(self.values)
+
+        idx = np.column_stack([np.clip(np.searchsorted(self.axes[k], x[:,k])-1, 0, len(self.axes[k])-2) for k in range(N)])
+        lo = np.column_stack([self.axes[k][idx[:,k]] for k in range(N)])
+        hi = np.column_stack([self.axes[k][idx[:,k]+1] for k in range(N)])
+        t = (x-lo)/(hi-lo)
+
+        # flat indices of the corners; vertex j is on the upper knot along
+        # axis k if the k-th bit of j is set:
+        shape = tuple(len(a) for a in self.axes)
+        shifts = (np.arange(2**N)[:,None] >> np.arange(N)) & 1
+        self.corners = np.ravel_multi_index(idx.T, shape)[:,None] + np.ravel_multi_index(shifts.T, shape)
+
+        # weights of the corners, built up one axis at a time:
+        self.weights = np.ones((len(x), 1))
+        for k in range(N):
+            self.weights = np.hstack((self.weights*(1-t[:,k:k+1]), self.weights*t[:,k:k+1]))
+
+        self.cache = {}
+        return True
+
+    def __call__(self, grid, mus=None, mu_axis=None):
+        """
+        @grid: grid of function values spanned by the axes
+        @mus: optional array of per-element mu values
+        @mu_axis: mu axis of the grid, required if mus are given
+
+        Returns an array of interpolated values, one per element; if mus are
+        given, the values are also interpolated in mu.
+        """
+
+        if id(grid) not in self.cache or self.cache[id(grid)][0] is not grid:
+            fv = grid.reshape((-1,) + grid.shape[len(self.axes):])[self.corners]
+            self.cache[id(grid)] = (grid, (fv*self.weights.reshape(self.weights.shape + (1,)*(fv.ndim-2))).sum(axis=1))
+        rv = self.cache[id(grid)][1]
+
+        if mus is None:
+            return rv
+
+        i = np.clip(np.searchsorted(mu_axis, mus)-1, 0, len(mu_axis)-2)
+        t = ((mus-mu_axis[i])/(mu_axis[i+1]-mu_axis[i])).reshape((-1,) + (1,)*(rv.ndim-2))
+        rows = np.arange(len(rv))
+        return rv[rows,i] + t*(rv[rows,i+1]-rv[rows,i])
+
+
+# Let's take a mesh of $10^5$ surface elements with solar-like atmospheric parameters, make sure that the interpolator reproduces `pb.Inorm()` and `ndpolate_batch()`, and compare the time costs:
+
+# In[ ]:
+
+
+rng = np.random.default_rng(2)
+M = 10**5
+mesh_teffs = rng.normal(5772, 150, M)
+mesh_loggs = rng.uniform(4.2, 4.5, M)
+mesh_abuns = np.zeros(M)
+mesh_mus = rng.uniform(0.05, 1, M)
+
+caxes = pb._ck2004_axes
+mu_axis = pb._ck2004_intensity_axes[-1]
+
+start = time.perf_counter()
+inorms = pb.Inorm(mesh_teffs, mesh_loggs, mesh_abuns, atm='ck2004')
+print(f'pb.Inorm():                      {time.perf_counter()-start:.4f} s')
+
+start = time.perf_counter()
+interp = MeshInterpolator(caxes, mesh_teffs, mesh_loggs, mesh_abuns)
+print(f'interpolator setup:              {time.perf_counter()-start:.4f} s')
+
+start = time.perf_counter()
+interp_inorms = 10**interp(pb._ck2004_energy_grid)[:,0]
+print(f'first evaluation:                {time.perf_counter()-start:.4f} s')
+
+start = time.perf_counter()
+interp_inorms = 10**interp(pb._ck2004_energy_grid)[:,0]
+print(f'repeated evaluation (cached):    {time.perf_counter()-start:.4f} s')
+
+start = time.perf_counter()
+recomputed = interp.update(mesh_teffs, mesh_loggs, mesh_abuns)
+print(f'update with unchanged inputs:    {time.perf_counter()-start:.4f} s (recomputed: {recomputed})')
+
+start = time.perf_counter()
+_ = interp(pb._ck2004_photon_grid)
+print(f'evaluation of another grid:      {time.perf_counter()-start:.4f} s')
+
+start = time.perf_counter()
+interp_imus = interp(pb._ck2004_Imu_energy_grid, mus=mesh_mus, mu_axis=mu_axis)[:,0]
+print(f'specific intensities:            {time.perf_counter()-start:.4f} s')
+
+start = time.perf_counter()
+_ = interp(pb._ck2004_Imu_energy_grid, mus=rng.uniform(0.05, 1, M), mu_axis=mu_axis)
+print(f'specific intensities at new mus: {time.perf_counter()-start:.4f} s')
+
+assert np.allclose(interp_inorms, inorms)
+x = np.column_stack((mesh_teffs, mesh_loggs, mesh_abuns, mesh_mus))
+assert np.allclose(interp_imus, ndpolate_batch(x, *hypercubes(x, pb._ck2004_intensity_axes, pb._ck2004_Imu_energy_grid))[:,0])
+
+
+# ### Parallel table builds
+# 
+# Imputation in the reduced 3-D space treats each $\mu$ slice independently, and each passband is independent of all others. When atmosphere grids are updated, we need to rebuild the tables of every passband, so it pays to distribute the work over a pool of processes. Each grid is copied into a block of shared memory once; workers attach to that block, impute their $\mu$ slice with `impute_grid()` and write the result back in place. Slices do not overlap, so no locking is needed, and the result is identical to the serial build. The worker function is defined in this notebook, so we use the `fork` start method to make it available to the workers.
+
+# In[ ]:
+
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+def impute_slice(args):
+    shm_name, shape, dtype, axes, i = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    grid = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    grid[...,i,:], _ = impute_grid(axes, grid[...,i,:])
+    shm.close()
+    return grid[...,i,:].size
+
+
+def build_imputed_tables(jobs, processes=None):
+    """
+    @jobs: list of (axes, grid) pairs, where mu is the last axis
+    @processes: number of worker processes; if 1, tables are built serially
+
+    Returns a list of imputed grids, one per job, and the throughput in grid
+    cells per second.
+    """
+
+    start = time.perf_counter()
+
+    if processes == 1:
+        grids = []
+        for axes, grid in jobs:
+            grid = grid.copy()
+            for i in range(len(axes[-1])):
+                grid[...,i,:], _ = impute_grid(axes[:-1], grid[...,i,:])
+            grids.append(grid)
+        return grids, sum(grid.size for grid in grids)/(time.perf_counter()-start)
+
+    blocks, shared_grids, tasks = [], [], []
+    for axes, grid in jobs:
+        shm = shared_memory.SharedMemory(create=True, size=grid.nbytes)
+        shared_grids.append(np.ndarray(grid.shape, dtype=grid.dtype, buffer=shm.buf))
+        shared_grids[-1][:] = grid
+        blocks.append(shm)
+        tasks += [(shm.name, grid.shape, grid.dtype, axes[:-1], i) for i in range(len(axes[-1]))]
+
+    try:
+        with ProcessPoolExecutor(processes, mp_context=mp.get_context('fork')) as pool:
+            cells = sum(pool.map(impute_slice, tasks))
+        grids = [shared.copy() for shared in shared_grids]
+    finally:
+        # arrays must be released before the shared memory blocks are closed:
+        shared_grids.clear()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return grids, cells/(time.perf_counter()-start)
+
+
+# Let's rebuild the energy- and photon-weighted specific intensity tables of all installed passbands for both ck2004 and phoenix atmospheres, serially and in parallel:
+
+# In[ ]:
+
+
+jobs = []
+for pbname in phoebe.list_installed_passbands():
+    ipb = phoebe.get_passband(pbname)
+    for atm in ('ck2004', 'phoenix'):
+        for weighting in ('energy', 'photon'):
+            jobs.append((getattr(ipb, f'_{atm}_intensity_axes'), getattr(ipb, f'_{atm}_Imu_{weighting}_grid')))
+
+serial_grids, serial_throughput = build_imputed_tables(jobs, processes=1)
+parallel_grids, parallel_throughput = build_imputed_tables(jobs)
+
+assert all(np.array_equal(s, p, equal_nan=True) for s, p in zip(serial_grids, parallel_grids))
+print(f'{len(jobs)} tables, {sum(grid.size for axes, grid in jobs)} grid cells')
+print(f'serial:   {serial_throughput:10.0f} grid cells per second')
+print(f'parallel: {parallel_throughput:10.0f} grid cells per second ({mp.cpu_count()} cores)')
+
+
 # In[ ]:
 
 
@@ -21,7 +21,7 @@
 
 # # Setup
 # 
-# As usual, we start with the imports, logger setup, and default binary initialization:
+# As usual, we start with the imports, logger setup, and default binary initialization. Like the rest of this workshop series, this tutorial targets PHOEBE 2.4: some of the code below works with passband tables and backend functions whose internals changed in PHOEBE 2.5.
 
 # In[ ]:
 
@@ -47,10 +47,200 @@ b.add_dataset('rv', compute_times=phoebe.linspace(0, 1, 26))
 # 
 # For systems without time-dependence (no apsidal motion, etc), it can therefore be quite advantageous to compute the forward model sampled in phase-space and interpolate when comparing to the observations (PHOEBE will handle this interpolation for you).  Just check to make sure that you sample sufficiently in phase that the linear interpolation won't introduce any systematics.
 
+# How many phases are "sufficient" depends on the system: a light curve is smooth and nearly linear out of eclipse, but changes rapidly during the eclipses (and in the vicinity of spots). Instead of hand-picking a uniform grid, we can let the model decide where it needs to be sampled more densely. Below, `adaptive_phases()` starts from a coarse uniform grid and, for each interval between neighboring phases, computes the model at the midpoint and compares it to the linear interpolation from the interval endpoints. Intervals where the interpolation error exceeds the tolerance (in units of the dataset `sigmas`) are split at the midpoint and tested again in the next round; all midpoints of a round are computed in a single `run_compute` call. Midpoints of intervals that pass the test are only used for testing, so the final grid is only as dense as it needs to be. Keep in mind that the model itself is subject to numerical noise (see the section on the number of triangles below), so the tolerance should be set above that noise level; as a safeguard, intervals are not split below `min_step`.
+# 
+# All trial computations are done on a copy of the bundle, and by default the resulting phases are only returned. With `store=True`, they are stored as the `compute_phases` of the dataset, so that all subsequent computations (including solver iterations) reuse them. Note that this requires `compute_phases` to be the free parameter, so the constraint with `compute_times` is flipped if needed.
+
+# In[ ]:
+
+
+import numpy as np
+
+def adaptive_phases(b, dataset='lc01', tolerance=0.5, n_initial=21, min_step=1e-3, max_rounds=10, default_sigma=1e-3, store=False):
+    """
+    @b: bundle
+    @dataset: light curve dataset to sample
+    @tolerance: maximum allowed interpolation error, in units of sigmas
+    @n_initial: number of phases in the initial uniform grid
+    @min_step: intervals narrower than this (in phase) are not split further
+    @max_rounds: maximum number of refinement rounds
+    @default_sigma: sigma relative to the median flux, used if the dataset has no sigmas
+    @store: if True, the phases are stored as compute_phases of the dataset,
+            flipping the compute_phases constraint if needed; if False, the
+            bundle is left untouched
+
+    Returns the adaptive phase grid and the number of forward model evaluations.
+    """
+
+    def free_compute_phases(bundle):
+        if bundle.get_parameter(qualifier='compute_phases', dataset=dataset, context='dataset').is_constraint:
+            bundle.flip_constraint(qualifier='compute_phases', dataset=dataset, solve_for='compute_times')
+
+    bc = b.copy()
+    free_compute_phases(bc)
+
+    def fluxes_at(phases):
+        bc.set_value(qualifier='compute_phases', dataset=dataset, context='dataset', value=phases)
+        bc.run_compute(dataset=dataset, model='phase_trial', overwrite=True, progressbar=False)
+        return bc.get_value(qualifier='fluxes', dataset=dataset, model='phase_trial')
+
+    phases = np.linspace(-0.5, 0.5, n_initial)
+    fluxes = fluxes_at(phases)
+    evaluations = len(phases)
+
+    sigmas = b.get_value(qualifier='sigmas', dataset=dataset, context='dataset', check_visible=False)
+    sigma = np.median(sigmas) if len(sigmas) else default_sigma*np.median(fluxes)
+
+    intervals = np.arange(len(phases)-1)
+    for _ in range(max_rounds):
+        midphases = 0.5*(phases[intervals]+phases[intervals+1])
+        midfluxes = fluxes_at(midphases)
+        evaluations += len(midphases)
+
+        refine = np.abs(midfluxes-0.5*(fluxes[intervals]+fluxes[intervals+1]))/sigma > tolerance
+        refine &= phases[intervals+1]-phases[intervals] > 2*min_step
+        if not refine.any():
+            break
+
+        phases = np.concatenate((phases, midphases[refine]))
+        fluxes = np.concatenate((fluxes, midfluxes[refine]))
+        order = np.argsort(phases)
+        phases, fluxes = phases[order], fluxes[order]
+
+        # both halves of each split interval are tested in the next round (in
+        # phase order, as the model is returned sorted in time):
+        splits = np.searchsorted(phases, midphases[refine])
+        intervals = np.sort(np.concatenate((splits-1, splits)))
+
+    if store:
+        free_compute_phases(b)
+        b.set_value(qualifier='compute_phases', dataset=dataset, context='dataset', value=phases)
+
+    return phases, evaluations
+
+
+# Let's sample our light curve adaptively and compare the linearly interpolated model to a densely sampled one, along with the same comparison for a uniform grid with the same number of phases. We leave `b` (and its 101 uniform `compute_times`, which the rest of this tutorial uses) untouched and do the comparison on a copy:
+
+# In[ ]:
+
+
+import matplotlib.pyplot as plt
+
+phases, evaluations = adaptive_phases(b, tolerance=0.5)
+print(f'adaptive grid: {len(phases)} phases, {evaluations} forward model evaluations')
+
+bd = b.copy()
+bd.flip_constraint(qualifier='compute_phases', dataset='lc01', solve_for='compute_times')
+bd.set_value(qualifier='compute_phases', dataset='lc01', context='dataset', value=phoebe.linspace(-0.5, 0.5, 501))
+bd.run_compute(dataset='lc01', model='dense_grid', progressbar=False)
+dense_phases = bd.get_value(qualifier='compute_phases', dataset='lc01', context='dataset')
+dense_fluxes = bd.get_value(qualifier='fluxes', dataset='lc01', model='dense_grid')
+
+bd.set_value(qualifier='compute_phases', dataset='lc01', context='dataset', value=phases)
+bd.run_compute(dataset='lc01', model='adaptive_grid', progressbar=False)
+adaptive_fluxes = bd.get_value(qualifier='fluxes', dataset='lc01', model='adaptive_grid')
+
+uniform_phases = np.linspace(-0.5, 0.5, len(phases))
+bd.set_value(qualifier='compute_phases', dataset='lc01', context='dataset', value=uniform_phases)
+bd.run_compute(dataset='lc01', model='uniform_grid', progressbar=False)
+uniform_fluxes = bd.get_value(qualifier='fluxes', dataset='lc01', model='uniform_grid')
+
+adaptive_errors = np.interp(dense_phases, phases, adaptive_fluxes)-dense_fluxes
+uniform_errors = np.interp(dense_phases, uniform_phases, uniform_fluxes)-dense_fluxes
+print(f'max interpolation error: adaptive {np.abs(adaptive_errors).max():.2e}, uniform {np.abs(uniform_errors).max():.2e}')
+
+_ = plt.plot(dense_phases, uniform_errors, 'b-', label='uniform')
+_ = plt.plot(dense_phases, adaptive_errors, 'r-', label='adaptive')
+_ = plt.plot(phases, np.zeros_like(phases), 'k|')
+_ = plt.legend()
+
+
 # # Number of Triangles
 # 
 # Similarly, the expense of building meshes scales with the number of triangles (and so does the expense of irradiation which we return to later).  The default number of triangles in PHOEBE is quite low, for this reason.  However, an insufficient number of triangles can result in numerical noise both on the horizon and during the eclipse.  In some cases, it may be worth some extra up-front effort to determine the (approximate) minimum number of triangles needed to achieve the minimum signal-to-noise ration suitable for the data.
 
+# Rather than doing trial runs by hand, we can search for that minimum: for each component in turn, we bisect (in log-space) between a coarse mesh and a high-resolution reference mesh, keeping the other components at the reference resolution. For each trial resolution we measure the numerical noise, i.e. the maximum deviation from the reference light curve in units of the dataset `sigmas`, separately out of eclipse (noise on the horizon) and in eclipse, and we keep the smallest resolution where both are within the requested fraction of sigmas. As numerical noise is not a strictly monotonic function of the number of triangles, we finally verify the combined solution for all components, increasing all resolutions by the same factor until the combination meets the target as well. The run time is recorded at each evaluated resolution.
+
+# In[ ]:
+
+
+import time
+import numpy as np
+
+def minimal_ntriangles(b, dataset='lc01', fraction=0.1, ntriangles_min=200, ntriangles_ref=5000, ratio=1.1, default_sigma=1e-3):
+    """
+    @b: bundle
+    @dataset: light curve dataset to measure numerical noise on
+    @fraction: maximum allowed numerical noise, in units of sigmas
+    @ntriangles_min: coarsest mesh to consider
+    @ntriangles_ref: resolution of the reference mesh
+    @ratio: the search stops once the bracketing resolutions are within this ratio
+    @default_sigma: sigma relative to the median flux, used if the dataset has no sigmas
+
+    Returns a dictionary of minimal ntriangles per component and a list of
+    (ntriangles, horizon noise, eclipse noise, run time) records.
+    """
+
+    b = b.copy()
+    components = b.filter(qualifier='ntriangles', context='compute').components
+    records = []
+
+    def run(ntriangles):
+        for component, value in ntriangles.items():
+            b.set_value_all(qualifier='ntriangles', component=component, context='compute', value=value)
+        start = time.perf_counter()
+        b.run_compute(dataset=dataset, model='mesh_trial', overwrite=True, progressbar=False)
+        elapsed = time.perf_counter()-start
+        return b.get_value(qualifier='fluxes', dataset=dataset, model='mesh_trial'), elapsed
+
+    reference, elapsed = run({component: ntriangles_ref for component in components})
+    in_eclipse = reference < reference.max() - 0.05*(reference.max()-reference.min())
+    sigmas = b.get_value(qualifier='sigmas', dataset=dataset, context='dataset', check_visible=False)
+    if len(sigmas) != len(reference):
+        sigmas = np.median(sigmas) if len(sigmas) else default_sigma*np.median(reference)
+    records.append(({component: ntriangles_ref for component in components}, 0., 0., elapsed))
+
+    def noise(ntriangles):
+        fluxes, elapsed = run(ntriangles)
+        deviations = np.abs(fluxes-reference)/sigmas
+        records.append((dict(ntriangles), deviations[~in_eclipse].max(), deviations[in_eclipse].max() if in_eclipse.any() else 0., elapsed))
+        return max(records[-1][1:3])
+
+    solution = {}
+    for component in components:
+        ntriangles = {comp: ntriangles_ref for comp in components}
+        lo, hi = ntriangles_min, ntriangles_ref
+        ntriangles[component] = lo
+        if noise(ntriangles) <= fraction:
+            hi = lo
+        while hi/lo > ratio:
+            ntriangles[component] = mid = int(np.sqrt(lo*hi))
+            if noise(ntriangles) <= fraction:
+                hi = mid
+            else:
+                lo = mid
+        solution[component] = hi
+
+    # noise from all components adds up, so refine the combined solution if needed:
+    while noise(solution) > fraction and min(solution.values()) < ntriangles_ref:
+        solution = {component: min(int(ratio*value), ntriangles_ref) for component, value in solution.items()}
+
+    return solution, records
+
+
+# Let's find the minimal meshes for which numerical noise stays below a tenth of the sigmas:
+
+# In[ ]:
+
+
+solution, records = minimal_ntriangles(b, fraction=0.1)
+
+print(f"{'ntriangles':36s} {'horizon':>8s} {'eclipse':>8s} {'time [s]':>9s}")
+for ntriangles, horizon_noise, eclipse_noise, elapsed in records:
+    print(f'{str(ntriangles):36s} {horizon_noise:8.3f} {eclipse_noise:8.3f} {elapsed:9.2f}')
+print(f'minimal ntriangles: {solution}')
+
+
 # # Eclipse Detection
 # 
 # For more details, see [Eclipse Detection](http://phoebe-project.org/docs/2.4/tutorials/eclipse.ipynb).
@@ -149,6 +339,162 @@ b.set_value(qualifier='fti_method', value='oversample')
 print(b.get_parameter(qualifier='fti_oversample'))
 
 
+# # Profiling Computations
+# 
+# The sections above list the usual cost drivers, but `run_compute` itself only tells us the total time, and how that time is divided between the stages of the backend depends strongly on the system (and the datasets). Before deciding which approximations are worth considering, it helps to know where the time actually goes. Below, `profile_compute()` temporarily wraps the backend functions of each stage with a timer and a call counter, runs the forward model, and returns the timings as a ParameterSet of `<stage>_time` and `<stage>_calls` parameters, tagged with the label of the model. The times are exclusive, i.e. time spent in a nested stage (for example intensity lookups while populating the mesh) is only counted once, for the nested stage. The stages are:
+# 
+# * `mesh`/`remesh`: building the mesh of each star, where `remesh` counts the meshes that need to be rebuilt at each time point (for example to conserve volume in eccentric orbits),
+# * `local_quantities`: surface gravities, temperatures, etc. of the mesh elements,
+# * `dynamics`: positions and velocities of the stars,
+# * `eclipse`: horizon and eclipse detection,
+# * `irradiation`: reflection and heating,
+# * `intensities` and `ld`: intensity and limb darkening lookups in the passband tables,
+# * `populate`: filling the remaining observable columns of the meshes,
+# * `lc_integration`/`rv_integration`: integrating the fluxes and the intensity-weighted RVs over the visible elements,
+# * `interpolation`: interpolation of the model in time (for example to the times of the observations when computing residuals),
+# * `residuals`: the rest of `calculate_residuals` for the datasets with observations (if requested), which runs after `run_compute`,
+# * `other`: everything else in `run_compute` (frontend checks, FTI averaging, etc).
+# 
+# We report the time of `run_compute` and the total (including the residuals) separately, so that `other` only refers to `run_compute` itself.
+# 
+# Only the functions that exist in the installed version of PHOEBE are wrapped; any stage that is not used by a given computation is simply reported with zero calls.
+
+# In[ ]:
+
+
+import functools
+from phoebe import dynamics
+from phoebe.backend import universe
+from phoebe.atmospheres import passbands
+from phoebe.parameters import parameters
+
+def defined(owners, names):
+    """
+    @owners: list of classes and/or modules
+    @names: list of function names
+
+    Returns the (owner, name) pairs of the functions that are defined by the owners.
+    """
+
+    return [(owner, name) for owner in owners for name in names if callable(vars(owner).get(name, None))]
+
+universe_classes = [cls for cls in vars(universe).values() if isinstance(cls, type) and cls.__module__ == universe.__name__]
+dynamics_modules = [getattr(dynamics, name) for name in ('keplerian', 'nbody') if hasattr(dynamics, name)]
+
+# stage names (or functions of the call arguments returning the stage name) and the functions they wrap:
+profile_stages = [
+    (lambda self, *args, **kwargs: 'remesh' if self.needs_remesh else 'mesh', defined(universe_classes, ['_build_mesh'])),
+    ('local_quantities', defined(universe_classes, ['compute_local_quantities'])),
+    ('dynamics', defined(dynamics_modules, ['dynamics_from_bundle'])),
+    ('eclipse', defined([universe.System], ['handle_eclipses'])),
+    ('irradiation', defined([universe.System], ['handle_reflection'])),
+    ('intensities', defined([passbands.Passband], ['Inorm', 'Imu', 'interpolate_inorms', 'interpolate_imus'])),
+    ('ld', defined([passbands.Passband], ['ldint', 'interpolate_ldints', 'interpolate_ldcoeffs', 'ld_func'])),
+    ('populate', defined(universe_classes, ['_populate_lc', '_populate_rv'])),
+    (lambda self, dataset, kind, *args, **kwargs: f'{kind}_integration', defined([universe.System], ['observe'])),
+    ('interpolation', defined([parameters.FloatArrayParameter], ['interp_value'])),
+]
+
+def profile_compute(b, model='profile', residuals=True, **kwargs):
+    """
+    @b: bundle
+    @model: label of the model
+    @residuals: whether to also profile computing the residuals for the datasets with observations
+    @kwargs: keyword arguments passed on to run_compute
+
+    Runs the forward model with per-stage timers and returns the timings as a
+    ParameterSet tagged with the model label.
+    """
+
+    times, calls, stack = {}, {}, []
+
+    def timed(stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            name = stage(*args, **kwargs) if callable(stage) else stage
+            if stack and stack[-1][0] == name:
+                # a stage calling itself (i.e. an overridden method calling its parent)
+                return func(*args, **kwargs)
+            stack.append([name, 0.0])
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter()-start
+                nested = stack.pop()[1]
+                times[name] = times.get(name, 0.0) + elapsed-nested
+                calls[name] = calls.get(name, 0) + 1
+                if stack:
+                    stack[-1][1] += elapsed
+        return wrapper
+
+    originals = [(owner, name, vars(owner)[name]) for stage, functions in profile_stages for owner, name in functions]
+    try:
+        for stage, functions in profile_stages:
+            for owner, name in functions:
+                setattr(owner, name, timed(stage, vars(owner)[name]))
+
+        start = time.perf_counter()
+        b.run_compute(model=model, **kwargs)
+        compute_time = time.perf_counter()-start
+        times['other'], calls['other'] = compute_time-sum(times.values()), 1
+
+        def calculate_residuals():
+            for param in b.filter(qualifier=['fluxes', 'rvs'], dataset=b.filter(model=model).datasets, context='dataset').to_list():
+                if len(param.get_value()):
+                    b.calculate_residuals(model=model, dataset=param.dataset, component=param.component)
+
+        if residuals:
+            timed('residuals', calculate_residuals)()
+        total = time.perf_counter()-start
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+    stages = ['mesh', 'remesh', 'local_quantities', 'dynamics', 'eclipse', 'irradiation', 'intensities', 'ld', 'populate', 'lc_integration', 'rv_integration', 'interpolation', 'residuals']
+    stages += [name for name in times if name not in stages+['other']]
+
+    params = []
+    for name in stages+['other']:
+        params += [parameters.FloatParameter(qualifier=f'{name}_time', value=times.get(name, 0.0), default_unit=u.s, description=f'Wall time spent in the {name} stage', model=model, context='model'),
+                   parameters.IntParameter(qualifier=f'{name}_calls', value=calls.get(name, 0), description=f'Number of calls to the {name} stage', model=model, context='model')]
+
+    print(f"{'stage':20s} {'time [s]':>9s} {'fraction':>9s} {'calls':>7s}")
+    for name in stages+['other']:
+        print(f"{name:20s} {times.get(name, 0.0):9.3f} {times.get(name, 0.0)/total:9.1%} {calls.get(name, 0):7d}")
+    print(f"{'run_compute':20s} {compute_time:9.3f} {compute_time/total:9.1%}")
+    print(f"{'total':20s} {total:9.3f}")
+
+    return parameters.ParameterSet(params)
+
+
+# Let's profile our system with its light curve and RVs:
+
+# In[ ]:
+
+
+timings = profile_compute(b, model='profile')
+
+
+# The timings are returned as a ParameterSet, so we can query them just like any other parameters:
+
+# In[ ]:
+
+
+print(timings.get_value(qualifier='eclipse_time', model='profile'))
+b.remove_model('profile')
+
+
+# For comparison, let's see how this changes for an eccentric orbit, where the stars need to be re-meshed and irradiation re-computed at each time point:
+
+# In[ ]:
+
+
+be = b.copy()
+be.set_value(qualifier='ecc', component='binary', value=0.2)
+timings_ecc = profile_compute(be, model='profile_ecc')
+
+
 # # Determining Safe Approximations
 # 
 # In order to set any of these approximations, we first want to make sure that the influence of that choice will have no detrimental impact on the resulting model.  In any real case, there will be some impact, of course.  But we can compute forward models both with and without the effect and compare the magnitude of the difference to either the amplitude of the signal or of the observational uncertainties.
@@ -207,8 +553,439 @@ _ = plt.plot(times, fluxes_distortion_rel, 'b.')
 np.max(abs(fluxes_irrad_rel))
 
 
+# # Screening Approximations
+# 
+# Comparing models by hand quickly gets tedious once we consider more than a couple of approximations, so let's automate it. Below, `screen_approximations()` takes a list of candidate compute overrides and computes each of them along with the reference model. The computations run concurrently, in separate processes, each working on its own copy of the bundle. For each candidate we report its maximum deviation from the reference in units of the dataset `sigmas`, along with its speedup. If a dataset has no `sigmas` (as is the case for synthetic datasets like ours), we fall back on a default: a fraction of the median flux for light curves and an absolute value in km/s for RVs.
+# 
+# Candidates that would not change anything (because the bundle already uses these values) are skipped. Approximations that are safe individually are not necessarily safe together, so the recommended compute is built greedily: starting from the fastest safe candidate that is actually faster than the reference, we keep adding the next fastest one as long as the combination stays within tolerance and is faster than the current recommendation. Note that the timings of the screening runs are measured within each process, so they are only meaningful if there are at least as many cores as concurrent processes; the combinations are therefore timed serially, against a serial run of the reference.
+
+# In[ ]:
+
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+def compute_overrides(b, overrides):
+    """
+    @b: bundle; the screening model is added to and removed from it
+    @overrides: dictionary of compute parameter overrides
+
+    Runs the forward model with the overrides and returns a tuple of
+    synthetic observables, keyed by (dataset, component, qualifier), and
+    the wall time.
+    """
+
+    start = time.perf_counter()
+    b.run_compute(model='screen', overwrite=True, progressbar=False, **overrides)
+    elapsed = time.perf_counter()-start
+
+    observables = {(param.dataset, param.component, param.qualifier): param.get_value() for param in b.filter(model='screen', qualifier=['fluxes', 'rvs']).to_list()}
+    b.remove_model('screen')
+    return observables, elapsed
+
+def screen_approximations(b, candidates, tolerance=0.1, default_sigmas=None, processes=None):
+    """
+    @b: bundle
+    @candidates: list of dictionaries of compute parameter overrides
+    @tolerance: maximum allowed deviation from the reference, in units of sigmas
+    @default_sigmas: sigmas used for datasets without them; relative to the
+                     median flux for 'lc' and in km/s for 'rv'. If None,
+                     {'lc': 1e-3, 'rv': 1.0} is used
+    @processes: number of worker processes
+
+    Prints the screening results and returns a tuple of the recommended
+    overrides and the results per candidate.
+    """
+
+    if default_sigmas is None:
+        default_sigmas = {'lc': 1e-3, 'rv': 1.0}
+
+    def is_noop(overrides):
+        return all(np.array_equal(param.get_value(), value) for qualifier, value in overrides.items() for param in b.filter(qualifier=qualifier, context='compute', check_visible=False).to_list())
+
+    for overrides in [overrides for overrides in candidates if is_noop(overrides)]:
+        print(f'skipping {overrides}: already used by the bundle')
+    candidates = [overrides for overrides in candidates if not is_noop(overrides)]
+
+    # each task receives its own (pickled) copy of the bundle:
+    with ProcessPoolExecutor(processes, mp_context=mp.get_context('fork')) as pool:
+        runs = list(pool.map(compute_overrides, [b]*(len(candidates)+1), [{}]+candidates))
+    (reference, reference_time), runs = runs[0], runs[1:]
+
+    sigmas = {}
+    for dataset, component, qualifier in reference:
+        sigma = b.get_value(qualifier='sigmas', dataset=dataset, component=component, context='dataset', check_visible=False)
+        if len(sigma) == 0:
+            kind = b.get_dataset(dataset=dataset).kind
+            sigma = default_sigmas[kind]*np.median(reference[(dataset, component, qualifier)]) if kind == 'lc' else default_sigmas[kind]
+        elif len(sigma) != len(reference[(dataset, component, qualifier)]):
+            sigma = np.median(sigma)
+        sigmas[(dataset, component, qualifier)] = sigma
+
+    def deviation(observables):
+        return max(np.max(np.abs(observables[key]-reference[key])/sigmas[key]) for key in reference)
+
+    results = [{'overrides': overrides, 'deviation': deviation(observables), 'time': elapsed, 'speedup': reference_time/elapsed} for overrides, (observables, elapsed) in zip(candidates, runs)]
+
+    print(f"{'overrides':40s} {'max dev [sigma]':>15s} {'time [s]':>9s} {'speedup':>8s}")
+    print(f"{'reference':40s} {0:15.3f} {reference_time:9.2f} {1:8.2f}")
+    for result in results:
+        print(f"{str(result['overrides']):40s} {result['deviation']:15.3f} {result['time']:9.2f} {result['speedup']:8.2f} {'' if result['deviation'] <= tolerance else 'X'}")
+
+    # combinations are timed serially, so the reference is timed serially as well:
+    recommended = {}
+    _, serial_reference_time = compute_overrides(b.copy(), {})
+    recommended_time = serial_reference_time
+    for result in sorted([result for result in results if result['deviation'] <= tolerance and result['speedup'] > 1], key=lambda result: -result['speedup']):
+        observables, elapsed = compute_overrides(b.copy(), {**recommended, **result['overrides']})
+        if deviation(observables) <= tolerance and elapsed < recommended_time:
+            recommended.update(result['overrides'])
+            recommended_time, recommended_deviation = elapsed, deviation(observables)
+
+    if recommended:
+        print(f"\nrecommended: {recommended} (max dev {recommended_deviation:.3f} sigma, speedup {serial_reference_time/recommended_time:.2f})")
+    else:
+        print('\nno candidate is both faster and within tolerance')
+
+    return recommended, results
+
+
+# Let's screen all the approximations we discussed above, along with a coarser mesh:
+
+# In[ ]:
+
+
+candidates = [
+    {'irrad_method': 'none'},
+    {'distortion_method': 'sphere'},
+    {'rv_method': 'dynamical'},
+    {'eclipse_method': 'only_horizon'},
+    {'ntriangles': 500},
+    {'fti_method': 'none'},
+]
+
+recommended, results = screen_approximations(b, candidates, tolerance=0.1)
+
+
 # **IMPORTANT**: if you're fitting a system and applying any of these approximations, it is important to check the validity throughout the process (and particularly on the final solution - and then of course be transparent in any publications).  
 
+# # Rescaling Fluxes Instead of Recomputing
+# 
+# When fitting, solvers call `run_compute` over and over, and every call rebuilds the meshes, detects eclipses, computes irradiation and looks up intensities, even if the only parameters that changed since the last call are ones that do not affect any of these. The most common such parameters are the ones that merely scale the light curve: with `pblum_mode='component-coupled'` the synthetic fluxes are proportional to `pblum` of the reference component, they are inversely proportional to the square of the `distance`, and with `l3_mode='flux'` third light is simply added to them. If only these change, the new fluxes follow exactly from the previous ones:
+# 
+# $$ F' = (F - l_3) \, \frac{L'_\mathrm{pb}}{L_\mathrm{pb}} \left( \frac{d}{d'} \right)^2 + l'_3, $$
+# 
+# and RVs do not change at all.
+# 
+# Below, `RescalingCompute` keeps track of all component, system, dataset and compute parameters and of the model from the last actual forward model computation. When called, it compares the current parameter values to that snapshot: if nothing changed, the cached model is returned; if only scaling parameters changed, the cached model is rescaled; otherwise the forward model is computed and cached anew. Any parameter that appears or disappears between calls (for example, when a dataset or a feature is added) counts as changed.
+# 
+# Note that `RescalingCompute` only handles these flux scalings: it works on the level of the whole forward model, so a change of any other parameter -- `teffratio` included -- triggers a full computation. It does not reuse meshes, visibilities or any other intermediate stage of the backend between calls.
+
+# In[ ]:
+
+
+class RescalingCompute:
+    """
+    Forward model that is rescaled rather than recomputed when only flux scalings change.
+
+    Only pblum, l3 and distance changes are handled by rescaling; any other
+    change triggers a full forward model computation.
+    """
+
+    scaling_qualifiers = ('pblum', 'l3', 'distance')
+
+    def __init__(self, b, **kwargs):
+        """
+        @b: bundle
+        @kwargs: keyword arguments passed on to run_compute
+        """
+
+        self.b = b
+        self.kwargs = kwargs
+        self.snapshot = None
+        self.model = None
+        self.counts = {'computed': 0, 'rescaled': 0, 'cached': 0}
+
+    def parameters(self):
+        ps = self.b.filter(context=['component', 'system', 'dataset', 'compute'], check_visible=False, check_default=False)
+        return {param.twig: (param.qualifier, param.get_value()) for param in ps.to_list()}
+
+    def scalable(self, parameters, changed):
+        if not all(twig in parameters and twig in self.snapshot and self.snapshot[twig][0] in self.scaling_qualifiers for twig in changed):
+            return False
+        lcs = self.b.filter(qualifier='pblum_mode', context='dataset').datasets
+        return all(self.b.get_value(qualifier='pblum_mode', dataset=ds, context='dataset') == 'component-coupled' and self.b.get_value(qualifier='l3_mode', dataset=ds, context='dataset') == 'flux' for ds in lcs)
+
+    def __call__(self):
+        """
+        Returns synthetic observables, keyed by (dataset, component, qualifier).
+        """
+
+        parameters = self.parameters()
+        if self.snapshot is not None:
+            # parameters that were added or removed since the snapshot count as changed:
+            changed = [twig for twig in parameters.keys() | self.snapshot.keys() if twig not in parameters or twig not in self.snapshot or not np.array_equal(parameters[twig][1], self.snapshot[twig][1])]
+            if not changed:
+                self.counts['cached'] += 1
+                return self.model
+            if self.scalable(parameters, changed):
+                self.counts['rescaled'] += 1
+                return self.rescale(parameters)
+
+        self.b.run_compute(model='rescaling', overwrite=True, progressbar=False, **self.kwargs)
+        self.model = {(param.dataset, param.component, param.qualifier): param.get_value() for param in self.b.filter(model='rescaling', qualifier=['fluxes', 'rvs']).to_list()}
+        # run_compute itself may update some parameters (such as looked-up LD coefficients):
+        self.snapshot = self.parameters()
+        self.counts['computed'] += 1
+        return self.model
+
+    def rescale(self, parameters):
+        def ratio(twig):
+            return parameters[twig][1]/self.snapshot[twig][1]
+
+        model = dict(self.model)
+        distance_ratio = ratio('distance@system')
+        for (dataset, component, qualifier), fluxes in self.model.items():
+            if qualifier != 'fluxes':
+                continue
+            pblum_component = parameters[f'pblum_component@{dataset}@lc@dataset'][1]
+            pblum_ratio = ratio(f'pblum@{pblum_component}@{dataset}@lc@dataset')
+            l3, cached_l3 = parameters[f'l3@{dataset}@lc@dataset'][1], self.snapshot[f'l3@{dataset}@lc@dataset'][1]
+            model[(dataset, component, qualifier)] = (fluxes-cached_l3)*pblum_ratio/distance_ratio**2 + l3
+        return model
+
+
+# Let's check that rescaling reproduces the forward model exactly, and then compare the cost of a call that needs to be computed with one that is only rescaled:
+
+# In[ ]:
+
+
+bi = phoebe.default_binary()
+bi.add_dataset('lc', compute_phases=phoebe.linspace(0, 1, 51))
+rescaling = RescalingCompute(bi)
+
+start = time.perf_counter()
+rescaling()
+computed_time = time.perf_counter()-start
+
+bi.set_value(qualifier='pblum', component='primary', context='dataset', value=3.0)
+bi.set_value(qualifier='l3', context='dataset', value=0.2)
+bi.set_value(qualifier='distance', context='system', value=2.0)
+
+start = time.perf_counter()
+rescaled = rescaling()[('lc01', None, 'fluxes')]
+rescaled_time = time.perf_counter()-start
+
+bi.run_compute(model='check', progressbar=False)
+print(f"max relative difference: {np.max(np.abs(rescaled/bi.get_value(qualifier='fluxes', model='check')-1)):.2e}")
+print(f'computed: {computed_time:.3f} s, rescaled: {1e3*rescaled_time:.3f} ms')
+
+
+# In a fit, this pays off whenever the scaling parameters are fitted separately from the others -- for example, when we first adjust the passband luminosity and third light to the data, which is a very common first step. Here we fit them with a Nelder-Mead optimizer to synthetic "observations" with known values; as the forward model has already been computed above, none of the evaluations requires a full computation. We reset the counters first, so that they only include the fit:
+
+# In[ ]:
+
+
+from scipy.optimize import minimize
+
+sigma = 1e-3
+rng = np.random.default_rng(seed=42)
+obs_fluxes = (rescaled-0.2)*1.5/3.0+0.05 + rng.normal(0, sigma, len(rescaled))
+
+def chi2(values):
+    bi.set_value(qualifier='pblum', component='primary', context='dataset', value=values[0])
+    bi.set_value(qualifier='l3', context='dataset', value=values[1])
+    return np.sum(((rescaling()[('lc01', None, 'fluxes')]-obs_fluxes)/sigma)**2)
+
+rescaling.counts = dict.fromkeys(rescaling.counts, 0)
+start = time.perf_counter()
+result = minimize(chi2, x0=[2.0, 0.1], method='Nelder-Mead', bounds=[(0, None), (0, None)])
+print(f'pblum = {result.x[0]:.4f}, l3 = {result.x[1]:.4f} in {time.perf_counter()-start:.2f} s')
+print(f'{result.nfev} evaluations: {rescaling.counts}')
+
+
+# # Analytic Spherical Stars
+# 
+# With `distortion_method='sphere'` and `irrad_method='none'` -- as we often use while exploring parameter space -- a lot of the mesh machinery is no longer needed: each star is a sphere with a uniform surface, so its projection on the sky is a limb-darkened disc and an eclipse is simply one disc overlapping the other. The flux of the star behind then follows from integrating its intensity profile over the part of the disc that is not covered. Below, `SphericalCompute` does exactly that, for all times at once. Each disc is split into `nrings` concentric rings, and the fraction of each ring covered by the disc in front (an arc of the ring) is known analytically, so the integral becomes a sum over the rings. The intensity profiles $I(\mu)$ are looked up from the same passband tables (and limb-darkening options) as `run_compute` uses, and the positions come from the same Keplerian dynamics, so `ltte`, `dpdt` and `dperdt` are taken into account as well. The passband luminosities and third light follow from `compute_pblums` and `compute_l3s`, using `pblum_method='stefan-boltzmann'`, which is exact for spherical stars.
+# 
+# Like the rest of this workshop, `SphericalCompute` targets PHOEBE 2.4: intensities are looked up with `Passband.Imu()`, and the limb darkening source is resolved from `ld_mode` and `ld_coeffs_source` just like the 2.4 backend does it.
+# 
+# PHOEBE does not allow registering new backends for `add_compute`, so `SphericalCompute` takes the label of a set of compute options and checks that they are within the regime it supports (two spherical stars without irradiation, features or finite integration time, and only light curves) before returning the synthetic fluxes, keyed by (dataset, component, qualifier) as before.
+
+# In[ ]:
+
+
+from phoebe.dynamics import keplerian
+
+class SphericalCompute:
+    """
+    Mesh-free light curves of spherical stars, integrated over their overlapping limb-darkened discs.
+    """
+
+    def __init__(self, b, compute=None, nrings=500):
+        """
+        @b: bundle
+        @compute: label of the compute options
+        @nrings: number of rings each disc is split into
+        """
+
+        self.b = b
+        self.compute = b.get_compute(compute=compute).compute
+        self.stars = b.hierarchy.get_stars()
+        if len(self.stars) != 2 or len(b.hierarchy.get_envelopes()):
+            raise NotImplementedError('only detached binaries are supported')
+        if b.get_value(qualifier='irrad_method', compute=self.compute, context='compute') != 'none':
+            raise NotImplementedError("irrad_method must be 'none'")
+        for star in self.stars:
+            if b.get_value(qualifier='distortion_method', component=star, compute=self.compute, context='compute') != 'sphere':
+                raise NotImplementedError(f"distortion_method of {star} must be 'sphere'")
+        if len(b.filter(qualifier='enabled', compute=self.compute, context='compute', value=True).features):
+            raise NotImplementedError('features are not supported')
+
+        self.datasets = b.filter(qualifier='enabled', compute=self.compute, context='compute', value=True).datasets
+        for dataset in self.datasets:
+            if b.get_dataset(dataset=dataset).kind != 'lc':
+                raise NotImplementedError(f'only light curves are supported, {dataset} is not one')
+            if b.get_value(qualifier='pblum_mode', dataset=dataset, context='dataset') == 'dataset-scaled':
+                raise NotImplementedError("pblum_mode='dataset-scaled' is not supported")
+            if b.get_value(qualifier='exptime', dataset=dataset, context='dataset') > 0 and b.get_value(qualifier='fti_method', dataset=dataset, compute=self.compute, context='compute') != 'none':
+                raise NotImplementedError('finite integration times are not supported')
+
+        # midpoints of the rings, in units of the stellar radius, and the corresponding mu
+        self.r = (np.arange(nrings)+0.5)/nrings
+        self.mus = np.sqrt(1-self.r**2)
+
+    def intensities(self, dataset, star):
+        """
+        @dataset: label of the light curve
+        @star: label of the star
+
+        Returns the intensity profile of the star, I(mu), at the rings.
+        """
+
+        b = self.b
+        atm = b.get_value(qualifier='atm', component=star, compute=self.compute, context='compute')
+        # same choices of limb-darkening function, coefficients and atmosphere as in the backend
+        ld_mode = b.get_value(qualifier='ld_mode', dataset=dataset, component=star, context='dataset')
+        if ld_mode == 'interp':
+            ld_func, ld_coeffs, ldatm = 'interp', None, atm
+        elif ld_mode == 'lookup':
+            ld_func, ld_coeffs = b.get_value(qualifier='ld_func', dataset=dataset, component=star, context='dataset'), None
+            ldatm = b.get_value(qualifier='ld_coeffs_source', dataset=dataset, component=star, context='dataset')
+            if ldatm == 'auto':
+                ldatm = 'ck2004' if atm in ('blackbody', 'extern_atmx', 'extern_planckint') else atm
+        else:
+            ld_func = b.get_value(qualifier='ld_func', dataset=dataset, component=star, context='dataset')
+            ld_coeffs, ldatm = b.get_value(qualifier='ld_coeffs', dataset=dataset, component=star, context='dataset'), 'none'
+        pb = passbands.get_passband(b.get_value(qualifier='passband', dataset=dataset, context='dataset'))
+
+        n = len(self.mus)
+        return pb.Imu(Teff=np.full(n, b.get_value(qualifier='teff', component=star, context='component', unit=u.K)),
+                      logg=np.full(n, b.get_value(qualifier='logg', component=star, context='component')),
+                      abun=np.full(n, b.get_value(qualifier='abun', component=star, context='component')),
+                      mu=self.mus.copy(), atm=atm, ldatm=ldatm, ld_func=ld_func, ld_coeffs=ld_coeffs,
+                      photon_weighted=b.get_value(qualifier='intens_weighting', dataset=dataset, context='dataset') == 'photon').flatten()
+
+    def eclipsed_fraction(self, intensities, separations, radius_ratios):
+        """
+        @intensities: intensity profile of the star behind, at the rings
+        @separations: projected separations between the centers of the discs, in units of the radius of the star behind
+        @radius_ratios: radius of the star in front over the radius of the star behind
+
+        Returns the fraction of the flux of the star behind that is eclipsed, at each separation.
+        """
+
+        r = self.r[None, :]
+        z = np.maximum(separations, 1e-12)[:, None]
+        p = radius_ratios
+        # fraction of each ring that is covered by the disc in front: 0 if they don't overlap, 1 if the ring is entirely inside the disc
+        covered = np.arccos(np.clip((r**2 + z**2 - p**2)/(2*r*z), -1, 1))/np.pi
+        # the rings are equally spaced in r, so their areas are proportional to r
+        weights = intensities*self.r
+        return covered @ weights / np.sum(weights)
+
+    def __call__(self):
+        """
+        Returns synthetic fluxes, keyed by (dataset, component, qualifier).
+        """
+
+        b = self.b
+        b.run_delayed_constraints()
+        system, pblums_abs, pblums_scale, pblums_rel, pbfluxes = b.compute_pblums(compute=self.compute, pblum_method='stefan-boltzmann', ret_structured_dicts=True, skip_checks=True)
+        l3s = b.compute_l3s(compute=self.compute, use_pbfluxes=pbfluxes, ret_structured_dicts=True, skip_checks=True, skip_compute_ld_coeffs=True)
+        distance = b.get_value(qualifier='distance', context='system', unit=u.m)
+        requivs = [b.get_value(qualifier='requiv', component=star, context='component', unit=u.solRad) for star in self.stars]
+
+        model = {}
+        for dataset in self.datasets:
+            times = b.get_value(qualifier='compute_times', dataset=dataset, context='dataset', unit=u.d)
+            if not len(times):
+                times = b.get_value(qualifier='times', dataset=dataset, context='dataset', unit=u.d)
+            ts, xs, ys, zs, vxs, vys, vzs = keplerian.dynamics_from_bundle(b, times, compute=self.compute)
+            separations = np.sqrt((xs[0]-xs[1])**2 + (ys[0]-ys[1])**2)
+
+            fluxes = np.full(len(times), l3s.get(dataset, 0.0))
+            for i, (star, other) in enumerate([(0, 1), (1, 0)]):
+                # positive z points towards the observer
+                behind = zs[star] < zs[other]
+                eclipsed = np.zeros(len(times))
+                overlapping = behind & (separations < requivs[star] + requivs[other])
+                if np.any(overlapping):
+                    eclipsed[overlapping] = self.eclipsed_fraction(self.intensities(dataset, self.stars[star]), separations[overlapping]/requivs[star], requivs[other]/requivs[star])
+                fluxes += pblums_rel[dataset][self.stars[star]]/(4*np.pi*distance**2)*(1-eclipsed)
+            model[(dataset, None, 'fluxes')] = fluxes
+        return model
+
+
+# Let's compare to the mesh backend for a system with spherical stars and no irradiation. As the ring integration is essentially exact, the differences are dominated by the discretization of the meshes, and they decrease as we increase the number of triangles:
+
+# In[ ]:
+
+
+bs = phoebe.default_binary()
+bs.add_dataset('lc', compute_phases=phoebe.linspace(0, 1, 201))
+bs.set_value_all(qualifier='distortion_method', value='sphere')
+bs.set_value(qualifier='irrad_method', value='none')
+bs.set_value(qualifier='ecc', value=0.2)
+bs.set_value(qualifier='incl', component='binary', value=86)
+bs.set_value(qualifier='teff', component='secondary', value=5000)
+spherical = SphericalCompute(bs)
+
+for ntriangles in [1500, 6000]:
+    bs.set_value_all(qualifier='ntriangles', value=ntriangles)
+    start = time.perf_counter()
+    bs.run_compute(model='meshes', overwrite=True, progressbar=False)
+    mesh_time = time.perf_counter()-start
+
+    start = time.perf_counter()
+    fluxes = spherical()[('lc01', None, 'fluxes')]
+    spherical_time = time.perf_counter()-start
+
+    print(f"ntriangles={ntriangles}: max relative difference: {np.max(np.abs(fluxes/bs.get_value(qualifier='fluxes', model='meshes')-1)):.2e}")
+    print(f'mesh: {mesh_time:.2f} s, spherical: {1e3*spherical_time:.1f} ms')
+
+
+# This makes quick fitting passes in the spherical regime much cheaper. As an example, let's fit the temperature and the radius of the secondary to synthetic "observations" computed with the mesh backend:
+
+# In[ ]:
+
+
+sigma = 1e-3
+rng = np.random.default_rng(seed=42)
+obs_fluxes = bs.get_value(qualifier='fluxes', model='meshes') + rng.normal(0, sigma, 201)
+
+def spherical_chi2(values):
+    bs.set_value(qualifier='teff', component='secondary', value=values[0])
+    bs.set_value(qualifier='requiv', component='secondary', value=values[1])
+    return np.sum(((spherical()[('lc01', None, 'fluxes')]-obs_fluxes)/sigma)**2)
+
+start = time.perf_counter()
+result = minimize(spherical_chi2, x0=[5500.0, 0.9], method='Nelder-Mead')
+print(f'teff = {result.x[0]:.1f}, requiv = {result.x[1]:.4f} in {time.perf_counter()-start:.2f} s ({result.nfev} evaluations)')
+
+
+# Each evaluation takes a fraction of a second, most of which is now spent in setting the parameters and running the constraints in the frontend, compared to several seconds per evaluation with the mesh backend. Of course, the result of such a pass is only as good as the spherical approximation itself (see "Determining Safe Approximations" above), so it should be followed by computations with the full treatment before drawing any conclusions.
+
 # # Exercise
 # 
 # Take any of the systems you've built and determine which (if any) expensive effects can safely be ignored.
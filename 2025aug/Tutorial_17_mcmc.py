@@ -225,6 +225,556 @@ b.plot(solution='round_1', style='trace', burnin=0, thin=1, show=True)
 b.save('./data/synthetic/after_initial_sampling.bundle')
 
 
+# # Batched Forward Models
+# 
+# Both `run_compute(sample_from=...)` and the sampler evaluate the forward model one parameter set at a time. Below, `BatchedCompute` instead takes a whole batch of parameter vectors for a fixed list of parameters: an (N, k) array of values for the k parameters. The batch is split into chunks which are computed concurrently in separate processes, each of which works on its own copy of the bundle (inherited from the main process, so the bundle is not copied for every chunk). Every row is still a full call to `run_compute`, including the checks and constraints, so the gain comes from running the rows in parallel and not from skipping any of the work done for a single model. The result is an (N, ntimes) array per dataset and component; parameter vectors which fail the checks (for example because they result in an overflowing star) or for which the forward model fails are returned as rows of NaNs.
+
+# In[ ]:
+
+
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+batch_computes = {}
+
+def init_batch_worker(batched):
+    batch_computes['batched'] = batched
+
+def compute_chunk(values):
+    """
+    @values: (n, k) array of parameter values
+
+    Computes the forward model for each row of values in the worker's bundle
+    and returns a dictionary of (n, ntimes) arrays, keyed by (dataset,
+    component, qualifier).
+    """
+
+    batched = batch_computes['batched']
+    b = batched.b
+    observables = {key: np.full((len(values), len(times)), np.nan) for key, times in batched.times.items()}
+    for i, row in enumerate(values):
+        try:
+            # constraints are run once per row by run_compute, rather than after setting each value
+            for param, value in zip(batched.parameters, row):
+                param.set_value(value, run_checks=False, run_constraints=False)
+            b.remove_parameters_all(model=batched.model)
+            # run_compute raises if the row fails the checks, leaving a row of NaNs
+            b.run_compute(compute=batched.compute, model=batched.model, do_create_fig_params=False, progressbar=False)
+        except Exception:
+            continue
+        for dataset, component, qualifier in observables:
+            observables[(dataset, component, qualifier)][i] = b.get_value(qualifier=qualifier, dataset=dataset, component=component, model=batched.model)
+    return observables
+
+class BatchedCompute:
+    """
+    Forward model evaluated for a batch of parameter vectors at once.
+    """
+
+    # function computing a chunk of rows in a worker process
+    chunk_function = staticmethod(compute_chunk)
+
+    def __init__(self, b, twigs, compute=None, model='batch', processes=None):
+        """
+        @b: bundle
+        @twigs: list of twigs of the k parameters that vary between the rows of a batch
+        @compute: label of the compute options
+        @model: label of the model used for the computations
+        @processes: number of worker processes (defaults to the number of cores)
+        """
+
+        self.b = b.copy()
+        self.twigs = twigs
+        self.parameters = [self.b.get_parameter(twig) for twig in twigs]
+        self.compute = compute
+        self.model = model
+        self.processes = processes if processes is not None else mp.cpu_count()
+
+        report = self.b.run_checks_compute(compute=compute)
+        if not report.passed:
+            raise ValueError(report)
+
+        # compute the model once: this loads the passbands and determines the time grids
+        self.b.run_compute(compute=compute, model=model, overwrite=True, progressbar=False)
+        ps = self.b.filter(model=model, qualifier=['fluxes', 'rvs'])
+        self.times = {(param.dataset, param.component, param.qualifier): self.b.get_value(qualifier='times', dataset=param.dataset, component=param.component, model=model) for param in ps.to_list()}
+
+    def __call__(self, values):
+        """
+        @values: (N, k) array of parameter values
+
+        Returns a dictionary of (N, ntimes) arrays, keyed by (dataset, component, qualifier).
+        """
+
+        values = np.atleast_2d(values)
+        chunks = [chunk for chunk in np.array_split(values, min(self.processes, len(values))) if len(chunk)]
+        if len(chunks) == 1:
+            init_batch_worker(self)
+            return self.chunk_function(values)
+
+        with ProcessPoolExecutor(len(chunks), mp_context=mp.get_context('fork'), initializer=init_batch_worker, initargs=(self,)) as pool:
+            results = list(pool.map(self.chunk_function, chunks))
+        return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+
+
+# Let's evaluate our dynamical RV model for 50 parameter vectors drawn from the N-dimensional gaussian we defined earlier, and compare to sampling the same distribution with `run_compute`:
+
+# In[ ]:
+
+
+dc, twigs = b.get_distribution_collection(distribution='ndg')
+values = dc.sample(size=50)
+
+batched = BatchedCompute(b, twigs, compute='dyn_rv')
+start = time.perf_counter()
+rvs = batched(values)
+print(f'batched: {time.perf_counter()-start:.2f} s')
+print({key: rv.shape for key, rv in rvs.items()})
+
+start = time.perf_counter()
+b.run_compute(compute='dyn_rv', sample_from='ndg', sample_num=50, model='from_ndg', overwrite=True, progressbar=False)
+print(f'run_compute: {time.perf_counter()-start:.2f} s')
+
+
+# The rows of the batch are identical to computing the models one by one:
+
+# In[ ]:
+
+
+bc = b.copy()
+for twig, value in zip(twigs, values[0]):
+    bc.set_value(twig, value=value)
+bc.run_compute(compute='dyn_rv', model='check', progressbar=False)
+print(max(np.max(np.abs(rv[0]-bc.get_value(qualifier=qualifier, dataset=dataset, component=component, model='check'))) for (dataset, component, qualifier), rv in rvs.items()))
+
+
+# # Vectorized Likelihoods
+# 
+# The same approach works for the sampler itself. At each iteration, `emcee` proposes new positions for (half of) the ensemble of walkers at once, and if we tell it that our log-probability function is vectorized, it will pass all these proposals in a single call. Below, `BatchedLnProbability` builds on `BatchedCompute` to evaluate the log-probability for all of them in one batch, distributed over the local cores. For each walker, the log-probability is computed in the same sequence as the emcee solver does it: the sampled values are set, the delayed and failed constraints are run, the priors are evaluated (and the forward model is skipped if they are not finite), the forward model is computed (which fails if the walker does not pass the system checks), and the log-likelihood of the model is added to the priors. A walker that fails at any of these steps gets a log-probability of -inf, and the reason is recorded in `failed_samples`, just like the solver records its failed samples. The priors are frozen when `BatchedLnProbability` is created, so that any `*_around` priors stay centered on the face values at that time rather than following the sampled values. The parameters, priors and compute options are taken from the solver options, so we can run `emcee` directly, with the same setup as `run_solver`.
+
+# In[ ]:
+
+
+def lnprobability_chunk(values):
+    """
+    @values: (n, k) array of parameter values
+
+    Computes the log-probability for each row of values in the worker's
+    bundle and returns a dictionary with an (n,) array of log-probabilities
+    and an (n,) array of failure reasons (empty for successful rows).
+    """
+
+    batched = batch_computes['batched']
+    b = batched.b
+    lnprobabilities = np.full(len(values), -np.inf)
+    failures = np.full(len(values), '', dtype=object)
+    for i, row in enumerate(values):
+        try:
+            for param, value in zip(batched.parameters, row):
+                param.set_value(value, run_checks=False, run_constraints=False)
+        except Exception as err:
+            failures[i] = f'setting values: {err}'
+            continue
+
+        try:
+            b.run_delayed_constraints()
+            b.run_failed_constraints()
+        except Exception as err:
+            failures[i] = f'running constraints: {err}'
+            continue
+
+        try:
+            prior_values = [b.get_value(uniqueid=uniqueid, unit=dist.unit, check_visible=False, check_default=False) for uniqueid, dist in zip(batched.prior_uniqueids, batched.prior_dc.dists_unpacked)]
+            lnpriors = batched.prior_dc.logpdf(prior_values, as_univariates=False)
+        except Exception as err:
+            failures[i] = f'evaluating lnpriors: {err}'
+            continue
+        if not np.isfinite(lnpriors):
+            failures[i] = 'lnpriors = -inf'
+            continue
+
+        try:
+            b.remove_parameters_all(model=batched.model)
+            # as in the solver, the checks are run by run_compute, which raises if they fail
+            b.run_compute(compute=batched.compute, model=batched.model, do_create_fig_params=False, progressbar=False)
+            lnprobabilities[i] = lnpriors + b.calculate_lnlikelihood(model=batched.model, consider_gaussian_process=False)
+        except Exception as err:
+            failures[i] = f'computing model: {err}'
+            continue
+        if np.isnan(lnprobabilities[i]):
+            lnprobabilities[i], failures[i] = -np.inf, 'lnlikelihood = nan'
+    return {'lnprobability': lnprobabilities, 'failure': failures}
+
+class BatchedLnProbability(BatchedCompute):
+    """
+    Log-probability of the emcee solver, evaluated for a batch of walkers at once.
+    """
+
+    chunk_function = staticmethod(lnprobability_chunk)
+
+    def __init__(self, b, solver, processes=None):
+        """
+        @b: bundle
+        @solver: label of the emcee solver options
+        @processes: number of worker processes (defaults to the number of cores)
+        """
+
+        self.init_from, twigs = b.get_distribution_collection(qualifier='init_from', solver=solver)
+        self.priors = b.get_value(qualifier='priors', solver=solver, context='solver')
+        self.priors_combine = b.get_value(qualifier='priors_combine', solver=solver, context='solver', check_visible=False)
+        compute = b.get_value(qualifier='compute', solver=solver, context='solver')
+        super().__init__(b, twigs, compute=compute, model=f'{solver}_batch', processes=processes)
+
+        # as within the solver, *_around priors should not follow the sampled
+        # values: the collection is centered on the current face values, and
+        # as we evaluate it directly, it is never re-centered
+        self.prior_dc, self.prior_uniqueids = self.b.get_distribution_collection(distribution=self.priors, combine=self.priors_combine, include_constrained=True, keys='uniqueid')
+        self.failed_samples = []
+
+    def __call__(self, values):
+        """
+        @values: (N, k) array of parameter values
+
+        Returns an (N,) array of log-probabilities; failure reasons of rows
+        with -inf are appended to failed_samples as (reason, values) tuples.
+        """
+
+        results = super().__call__(values)
+        for failure, row in zip(results['failure'], np.atleast_2d(values)):
+            if failure:
+                self.failed_samples.append((failure, row.tolist()))
+        return results['lnprobability']
+
+
+# Let's draw the initial positions of the walkers from `init_from`, redrawing any walkers that start at a log-probability of -inf, and check the log-probabilities of the first few walkers against computing them one by one. We also add a walker with a mass ratio of 0.05, for which the secondary overflows its Roche lobe, to see that a walker failing the checks gets a log-probability of -inf in both cases:
+
+# In[ ]:
+
+
+lnprobability = BatchedLnProbability(b, solver='mcmc')
+nwalkers = b.get_value(qualifier='nwalkers', solver='mcmc')
+
+p0 = lnprobability.init_from.sample(size=nwalkers)
+start = time.perf_counter()
+lnp0 = lnprobability(p0)
+print(f'batched: {(time.perf_counter()-start)/nwalkers:.3f} s per walker')
+for attempt in range(10):
+    failed = ~np.isfinite(lnp0)
+    if not np.any(failed):
+        break
+    p0[failed] = lnprobability.init_from.sample(size=np.sum(failed))
+    lnp0[failed] = lnprobability(p0[failed])
+
+print(f'{len(lnprobability.failed_samples)} failed initial samples')
+for failure, values in lnprobability.failed_samples[:4]:
+    print(f'  {failure}')
+
+overflowing = p0[0].copy()
+overflowing[[param.qualifier for param in lnprobability.parameters].index('q')] = 0.05
+rows = np.vstack([p0[:4], overflowing])
+lnps = np.append(lnp0[:4], lnprobability(overflowing))
+print(f'overflowing walker: {lnprobability.failed_samples[-1][0]}')
+
+start = time.perf_counter()
+for values, lnp in zip(rows, lnps):
+    bc = b.copy()
+    for twig, value in zip(lnprobability.twigs, values):
+        bc.set_value(twig, value=value)
+    if not bc.run_checks_compute(compute='dyn_rv').passed:
+        print(lnp, -np.inf)
+        continue
+    bc.run_compute(compute='dyn_rv', model='check', progressbar=False)
+    print(lnp, bc.calculate_lnp(distribution=lnprobability.priors, combine=lnprobability.priors_combine, include_constrained=True) + bc.calculate_lnlikelihood(model='check'))
+print(f'one by one: {(time.perf_counter()-start)/len(rows):.3f} s per walker')
+
+
+# Now we can pass the batched log-probability to `emcee` with `vectorize=True`, and continue from the initial positions (and their already computed log-probabilities) for a few iterations. PHOEBE's emcee solver relies on the `emcee` package as well, so if you ran the solver above, it is already installed; otherwise, install it with `pip install emcee`:
+
+# In[ ]:
+
+
+try:
+    import emcee
+except ImportError:
+    raise ImportError('emcee is required for this section, install it with `pip install emcee`')
+
+sampler = emcee.EnsembleSampler(nwalkers, len(lnprobability.twigs), lnprobability, vectorize=True)
+start = time.perf_counter()
+sampler.run_mcmc(emcee.State(p0, log_prob=lnp0), 20, progress=True)
+print(f'{time.perf_counter()-start:.2f} s, mean acceptance fraction: {np.mean(sampler.acceptance_fraction):.2f}')
+
+for twig, values in zip(lnprobability.twigs, sampler.get_chain(flat=True).T):
+    print(f'{twig:40s} {np.median(values):10.4f} +/- {np.std(values):.4f}')
+
+
+# # Mesh-free Dynamical RVs
+# 
+# Each of our dynamical RV models still goes through the checks, the constraints and the general time loop of the backend, although the result only depends on the Keplerian orbit. For dynamical RVs and orbits we can skip all that: below, `kepler_dynamics()` solves Kepler's equation for all parameter vectors and all times at once, following the same conventions as the PHOEBE backend (including `dpdt`, `dperdt`, `vgamma` and the light travel time effect, `ltte`). `DynamicalCompute` has the same interface as `BatchedCompute`, but instead of setting values in the bundle, it takes the face values of the orbital parameters from the bundle once and replaces the sampled ones for each row. The few constraints that the dynamics depend on (the anomalistic period, the time of periastron passage, the semi-major axis if `asini` is fitted, and the semi-major axes of the components) are evaluated directly, also for all rows at once. As this bypasses the constraints of the bundle, only binaries with the default parameterization of the orbit (besides `asini`) are supported, and the times of the datasets may not depend on the sampled parameters.
+
+# In[ ]:
+
+
+from phoebe import u, c
+from phoebe.constraints import builtin
+
+def kepler_dynamics(times, period, ecc, sma, t0_perpass, per0, long_an, incl, dpdt, dperdt, t0, vgamma, secondary=False, ltte=False):
+    """
+    @times: array of (barycentric) times [d]
+    @period: anomalistic period of the orbit [d]
+    @ecc: eccentricity
+    @sma: semi-major axis of the component's orbit around the center of mass [solRad]
+    @t0_perpass: time of periastron passage [d]
+    @per0: argument of periastron at t0 [rad]
+    @long_an: longitude of the ascending node [rad]
+    @incl: inclination [rad]
+    @dpdt: time derivative of the period [d/d]
+    @dperdt: time derivative of the argument of periastron [rad/d]
+    @t0: reference time of the system [d]
+    @vgamma: systemic velocity [solRad/d]
+    @secondary: whether the component is the secondary in the orbit
+    @ltte: whether to correct for the light travel time effect
+
+    Orbital parameters are either floats or (N, 1) arrays, for N parameter
+    vectors. Returns the positions [solRad] and velocities [solRad/d] of the
+    component, as tuples of (N, ntimes) arrays.
+    """
+
+    if ltte:
+        # solve t_proper = t + z(t_proper)/c by fixed-point iteration, converging with v/c per iteration
+        scale = (c.R_sun/c.c).to(u.d).value
+        propertimes = times
+        for i in range(10):
+            z = kepler_dynamics(propertimes, period, ecc, sma, t0_perpass, per0, long_an, incl, dpdt, dperdt, t0, vgamma, secondary)[0][2]
+            propertimes, previous = times + z*scale, propertimes
+            if np.max(np.abs(propertimes-previous)) < 1e-12:
+                break
+        times = propertimes
+
+    if np.any(dpdt != 0):
+        # mass conservation: the semi-major axis follows Kepler's third law
+        period, period0 = dpdt*(times-t0) + period, period
+        sma = sma*period**2/period0**2
+    per0 = dperdt*(times-t0) + per0
+
+    M = 2*np.pi/period*(times-t0_perpass)
+    E = M + ecc*np.sin(M) + ecc**2/2*np.sin(2*M)
+    for i in range(30):
+        dE = (E - ecc*np.sin(E) - M)/(1 - ecc*np.cos(E))
+        E = E - dE
+        if np.max(np.abs(dE)) < 1e-12:
+            break
+    theta = 2*np.arctan2(np.sqrt(1+ecc)*np.sin(E/2), np.sqrt(1-ecc)*np.cos(E/2))
+
+    r = sma*(1 - ecc*np.cos(E))
+    L = 2*np.pi*sma**2/period*np.sqrt(1-ecc**2)
+    rdot = L/(r*(1 + ecc*np.cos(theta)))*ecc*np.sin(theta)
+    thetadot = L/r**2
+    theta_ = theta + per0 + (np.pi if secondary else 0)
+
+    x = r*(np.cos(long_an)*np.cos(theta_) - np.sin(long_an)*np.sin(theta_)*np.cos(incl))
+    y = r*(np.sin(long_an)*np.cos(theta_) + np.cos(long_an)*np.sin(theta_)*np.cos(incl))
+    z = r*np.sin(theta_)*np.sin(-incl) - vgamma*(times-t0)
+    vx_ = np.cos(theta_)*rdot - np.sin(theta_)*r*thetadot
+    vy_ = np.sin(theta_)*rdot + np.cos(theta_)*r*thetadot
+    vx = np.cos(long_an)*vx_ - np.sin(long_an)*vy_*np.cos(incl)
+    vy = np.sin(long_an)*vx_ + np.cos(long_an)*vy_*np.cos(incl)
+    vz = np.sin(-incl)*vy_ - vgamma
+
+    return np.broadcast_arrays(x, y, z), np.broadcast_arrays(vx, vy, vz)
+
+class DynamicalCompute:
+    """
+    Mesh-free forward model of dynamical RVs and orbits for a batch of parameter vectors at once.
+    """
+
+    # parameters of the orbit (and system) that the dynamics depend on, in the units used by kepler_dynamics
+    units = {'period': u.d, 't0_supconj': u.d, 't0_perpass': u.d, 'ecc': u.dimensionless_unscaled, 'per0': u.rad,
+             'long_an': u.rad, 'incl': u.rad, 'sma': u.solRad, 'asini': u.solRad, 'q': u.dimensionless_unscaled,
+             'dpdt': u.d/u.d, 'dperdt': u.rad/u.d, 'vgamma': u.solRad/u.d, 't0': u.d}
+
+    def __init__(self, b, twigs, compute=None):
+        """
+        @b: bundle
+        @twigs: list of twigs of the k parameters that vary between the rows of a batch
+        @compute: label of the compute options
+        """
+
+        if len(b.hierarchy.get_orbits()) != 1:
+            raise NotImplementedError('only binaries are supported')
+        self.orbit = b.hierarchy.get_top()
+        self.twigs = twigs
+        compute = b.get_compute(compute=compute).compute
+        self.ltte = b.get_value(qualifier='ltte', compute=compute, context='compute')
+
+        orbit_ps = b.filter(component=self.orbit, context='component')
+        for qualifier in ['period', 'ecc', 'per0']:
+            if orbit_ps.get_parameter(qualifier=qualifier).is_constraint is not None:
+                raise NotImplementedError(f'{qualifier} must not be constrained')
+        self.sma_from_asini = orbit_ps.get_parameter(qualifier='sma').is_constraint is not None
+        self.t0_from_supconj = orbit_ps.get_parameter(qualifier='t0_perpass').is_constraint is not None
+        if self.t0_from_supconj and orbit_ps.get_parameter(qualifier='t0_supconj').is_constraint is not None:
+            raise NotImplementedError('either t0_perpass or t0_supconj must not be constrained')
+
+        self.values = {qualifier: b.get_value(qualifier=qualifier, context='system' if qualifier in ['vgamma', 't0'] else 'component',
+                                              component=None if qualifier in ['vgamma', 't0'] else self.orbit, unit=unit)
+                       for qualifier, unit in self.units.items()}
+        self.sampled = []
+        self.limits = []
+        for twig in twigs:
+            param = b.get_parameter(twig)
+            if param.qualifier not in self.units or param.component not in [self.orbit, None] or param.is_constraint is not None:
+                raise NotImplementedError(f'sampling {twig} is not supported')
+            self.sampled.append((param.qualifier, (1*param.default_unit).to(self.units[param.qualifier]).value))
+            lower, upper = param.limits
+            self.limits.append((-np.inf if lower is None else lower.to(param.default_unit).value,
+                                np.inf if upper is None else upper.to(param.default_unit).value))
+        self.limits = np.array(self.limits).T
+
+        # (dataset, component, kind, secondary, times) for each synthetic observable
+        self.observables = []
+        # (secondary, times, rvs, sigmas**2) for each observed rv
+        self.observations = []
+        for dataset in b.filter(qualifier='enabled', compute=compute, context='compute', value=True).datasets:
+            # rvs and sigmas are hidden for datasets without observed times
+            ds_ps = b.get_dataset(dataset=dataset, check_visible=False)
+            if ds_ps.kind not in ['rv', 'orb']:
+                raise NotImplementedError(f"datasets of kind '{ds_ps.kind}' are not supported")
+            compute_times = ds_ps.get_parameter(qualifier='compute_times')
+            if compute_times.is_constraint is not None and set(qualifier for qualifier, factor in self.sampled) & {'period', 't0_supconj', 't0_perpass', 'dpdt', 'dperdt'}:
+                raise NotImplementedError(f'compute_times of {dataset} depend on the sampled parameters')
+            components = ds_ps.filter(qualifier='times').components if ds_ps.kind == 'rv' else b.hierarchy.get_stars()
+            for component in components:
+                if ds_ps.kind == 'rv' and b.get_value(qualifier='rv_method', component=component, compute=compute, context='compute') != 'dynamical':
+                    raise NotImplementedError(f'rv_method of {component} must be dynamical')
+                times = compute_times.get_value(unit=u.d)
+                if not len(times):
+                    times = ds_ps.get_value(qualifier='times', component=component if ds_ps.kind == 'rv' else None, unit=u.d)
+                secondary = b.hierarchy.get_primary_or_secondary(component) == 'secondary'
+                self.observables.append((dataset, component, ds_ps.kind, secondary, times))
+
+                if ds_ps.kind == 'rv' and len(ds_ps.get_value(qualifier='rvs', component=component, check_visible=False)):
+                    if ds_ps.get_value(qualifier='mask_enabled') and len(ds_ps.get_value(qualifier='mask_phases')):
+                        raise NotImplementedError(f'masking {dataset} is not supported')
+                    sigmas = ds_ps.get_value(qualifier='sigmas', component=component, unit=u.km/u.s)
+                    sigmas_lnf = ds_ps.get_value(qualifier='sigmas_lnf', component=component, check_visible=False)
+                    self.observations.append((secondary, ds_ps.get_value(qualifier='times', component=component, unit=u.d),
+                                              ds_ps.get_value(qualifier='rvs', component=component, unit=u.km/u.s, check_visible=False),
+                                              sigmas**2 + np.exp(2*sigmas_lnf) if len(sigmas) else None))
+
+    def parameters(self, values):
+        """
+        @values: (N, k) array of parameter values
+
+        Returns the orbital parameters as (N, 1) arrays, including the ones
+        derived through constraints.
+        """
+
+        values = np.atleast_2d(values)
+        p = {qualifier: np.full((len(values), 1), value) for qualifier, value in self.values.items()}
+        for (qualifier, factor), column in zip(self.sampled, values.T):
+            p[qualifier] = column[:, None]*factor
+
+        p['period_anom'] = p['period']/(1 - p['period']*p['dperdt']/(2*np.pi))
+        if self.sma_from_asini:
+            p['sma'] = p['asini']/np.sin(p['incl'])
+        if self.t0_from_supconj:
+            p['t0_perpass'] = builtin.t0_supconj_to_perpass(p['t0_supconj'], p['period'], p['ecc'], p['per0'], p['dpdt'], p['dperdt'], p['t0'])
+        return p
+
+    def dynamics(self, p, secondary, times):
+        """
+        @p: orbital parameters, as returned by parameters()
+        @secondary: whether the component is the secondary in the orbit
+        @times: array of times [d]
+        """
+
+        sma = p['sma']/(1 + p['q']) if secondary else p['sma']/(1 + 1/p['q'])
+        return kepler_dynamics(times, p['period_anom'], p['ecc'], sma, p['t0_perpass'], p['per0'], p['long_an'], p['incl'],
+                               p['dpdt'], p['dperdt'], p['t0'], p['vgamma'], secondary=secondary, ltte=self.ltte)
+
+    def __call__(self, values):
+        """
+        @values: (N, k) array of parameter values
+
+        Returns a dictionary of (N, ntimes) arrays, keyed by (dataset, component, qualifier).
+        """
+
+        p = self.parameters(values)
+        velocity = (1*u.solRad/u.d).to(u.km/u.s).value
+        results = {}
+        for dataset, component, kind, secondary, times in self.observables:
+            (x, y, z), (vx, vy, vz) = self.dynamics(p, secondary, times)
+            if kind == 'rv':
+                results[(dataset, component, 'rvs')] = -vz*velocity
+            else:
+                for qualifier, value in zip(['us', 'vs', 'ws', 'vus', 'vvs', 'vws'], [x, y, z, vx*velocity, vy*velocity, vz*velocity]):
+                    results[(dataset, component, qualifier)] = value
+        return results
+
+    def lnlikelihood(self, values):
+        """
+        @values: (N, k) array of parameter values
+
+        Returns an (N,) array of log-likelihoods of the observed rvs, with
+        -inf for rows outside the limits of the sampled parameters. Neither
+        the priors nor the system checks are included.
+        """
+
+        values = np.atleast_2d(values)
+        p = self.parameters(values)
+        velocity = (1*u.solRad/u.d).to(u.km/u.s).value
+        lnlikelihood = np.zeros(len(values))
+        for secondary, times, rvs, sigmas2 in self.observations:
+            (x, y, z), (vx, vy, vz) = self.dynamics(p, secondary, times)
+            residuals2 = (rvs + vz*velocity)**2
+            if sigmas2 is None:
+                lnlikelihood -= 0.5*np.sum(residuals2, axis=1)
+            else:
+                lnlikelihood -= 0.5*np.sum(residuals2/sigmas2 + np.log(2*np.pi*sigmas2), axis=1)
+
+        within_limits = np.all((values >= self.limits[0]) & (values <= self.limits[1]), axis=1)
+        return np.where(within_limits & ~np.isnan(lnlikelihood), lnlikelihood, -np.inf)
+
+
+# Let's check the mesh-free models against the batched models for the first few walkers, and time the evaluation of many more parameter vectors:
+
+# In[ ]:
+
+
+dynamical = DynamicalCompute(b, twigs, compute='dyn_rv')
+batched_rvs = batched(p0[:4])
+fast_rvs = dynamical(p0[:4])
+print(max(np.max(np.abs(fast_rvs[key]-rv)) for key, rv in batched_rvs.items()))
+
+many_values = dc.sample(size=10000)
+start = time.perf_counter()
+dynamical(many_values)
+print(f'mesh-free: {(time.perf_counter()-start)/len(many_values)*1e6:.1f} us per sample')
+
+
+# The log-likelihood is evaluated directly at the observed times, following `calculate_lnlikelihood`, and only checks the limits of the sampled parameters. Unlike the batched log-probability, it includes neither the priors nor the system checks: as the dynamics do not depend on the sizes of the stars, a parameter vector for which a star overflows its Roche lobe still gets a finite log-likelihood. Our solver has no priors and the first few walkers pass the checks, so for them we can compare it to the batched log-probabilities (any small differences come from the interpolation of the model to the observed times in `calculate_lnlikelihood`):
+
+# In[ ]:
+
+
+print(np.column_stack([lnp0[:4], dynamical.lnlikelihood(p0[:4])]))
+
+
+# With microseconds per sample, running `emcee` for many more iterations takes only seconds. Keep in mind that this samples the likelihood without the system checks, so it is worth running the checks for the resulting parameter values (or the batched log-probability for a subset of the chain) before trusting the posteriors:
+
+# In[ ]:
+
+
+sampler = emcee.EnsembleSampler(nwalkers, len(dynamical.twigs), dynamical.lnlikelihood, vectorize=True)
+start = time.perf_counter()
+sampler.run_mcmc(emcee.State(p0, log_prob=lnp0), 2000, progress=True)
+print(f'{time.perf_counter()-start:.2f} s, mean acceptance fraction: {np.mean(sampler.acceptance_fraction):.2f}')
+
+for twig, values in zip(dynamical.twigs, sampler.get_chain(discard=1000, flat=True).T):
+    print(f'{twig:40s} {np.median(values):10.4f} +/- {np.std(values):.4f}')
+
+
 # This concludes the basics of MCMC with PHOEBE! Now you can try it out yourself with these exercises!
 # 
 # # Exercises
@@ -3,7 +3,7 @@
 
 # ## PHOTOMETRIC CALIBRATION IN PHOEBE
 
-# In this tutorial we will explore basic photometric properties of observed objects as built into PHOEBE, along with the implementation rationale. First let's import all the modules we will need along the way:
+# In this tutorial we will explore basic photometric properties of observed objects as built into PHOEBE, along with the implementation rationale. Like the rest of this workshop series, it targets PHOEBE 2.4; the passband tables are accessed through the 2.4 `Passband` attributes, which changed in PHOEBE 2.5. First let's import all the modules we will need along the way:
 
 # In[1]:
 
@@ -506,3 +506,662 @@ plt.legend(loc='lower right')
 
 
 
+
+# ### Caching passband transmission functions
+# 
+# Throughout this tutorial we evaluated passband transmission functions on the very same wavelength arrays over and over again: `effwl()` alone calls `ptf()` up to 6 times per line, and we did the same when constructing integrands. Each call evaluates a cubic spline (`ptf_order=3`) on the entire array. The result depends only on the passband and the wavelength array, so we can cache it. We key the cache on the passband and on a hash of the wavelength array, so that equal grids hit the cache even if they are different array instances. The cache is bounded: when it is full, the least recently used entry is dropped. Cached transmissions are read-only, so that they cannot be accidentally modified in place; if a passband's transmission function changes, its cache entries need to be invalidated explicitly.
+
+# In[ ]:
+
+
+from collections import OrderedDict
+import hashlib
+import time
+
+ptf_cache = OrderedDict()
+ptf_cache_size = 64
+
+def cached_ptf(pb, wls):
+    """
+    @pb: Passband instance
+    @wls: wavelength array, in m
+
+    Returns a read-only array of pb.ptf(wls), evaluated only if the
+    (passband, wavelength array) pair is not cached already.
+    """
+
+    key = (f'{pb.pbset}:{pb.pbname}', id(pb), wls.shape, hashlib.blake2b(np.ascontiguousarray(wls).tobytes(), digest_size=16).digest())
+    if key in ptf_cache:
+        ptf_cache.move_to_end(key)
+        return ptf_cache[key]
+
+    ptf = pb.ptf(wls)
+    ptf.flags.writeable = False
+    ptf_cache[key] = ptf
+    if len(ptf_cache) > ptf_cache_size:
+        ptf_cache.popitem(last=False)
+    return ptf
+
+def invalidate_ptf_cache(pb=None):
+    """
+    @pb: Passband instance whose cached transmissions should be dropped; if
+         None, the whole cache is cleared
+    """
+
+    for key in [key for key in ptf_cache if pb is None or key[1] == id(pb)]:
+        del ptf_cache[key]
+
+
+# Let's see how a cached evaluation compares to evaluating the spline:
+
+# In[ ]:
+
+
+get_ipython().run_line_magic('timeit', 'jB.ptf(fwls_B)')
+get_ipython().run_line_magic('timeit', 'cached_ptf(jB, fwls_B)')
+
+# a different array instance with the same values hits the cache:
+assert cached_ptf(jB, fwls_B.copy()) is cached_ptf(jB, fwls_B)
+print(f'cached transmissions: {len(ptf_cache)}')
+invalidate_ptf_cache(jB)
+print(f'cached transmissions after invalidating Johnson:B: {len(ptf_cache)}')
+
+
+# For hot loops, where the same passband is applied to many SEDs on the same grid, it is best to fetch the transmission on the grid once and reuse the array directly -- this is exactly what `SyntheticPhotometry` below does, storing transmission functions of all passbands on the grid in its `ptfs` matrix. For example, the energy-weighted effective wavelengths of all spectral types in the B band:
+
+# In[ ]:
+
+
+ptf_B = cached_ptf(jB, fwls_B)
+for i, sptype in enumerate(sptypes):
+    wleff = (fwls_B*fseds_B[:,i]*ptf_B).sum()/(fseds_B[:,i]*ptf_B).sum()
+    print(f'{sptype}: wleff = {1e9*wleff:2.2f} nm')
+
+
+# ### Synthetic photometry of spectral libraries
+# 
+# Everything we computed above was done by hand: filter the wavelength array, evaluate the passband transmission function on it, multiply by each SED, divide by $hc$ and sum. That is fine for 4 spectra and 2 passbands, but calibrating an entire library of model spectra through a number of passbands calls for something more efficient. Note that, as long as all SEDs share the same wavelength grid, the integral of each SED through each passband is a weighted sum over wavelengths, where the weights depend *only* on the passband and the grid:
+# 
+# $$ f_E = \sum_i f_\lambda(\lambda_i) P(\lambda_i) \Delta\lambda_i, \quad f_P = \frac{1}{hc} \sum_i f_\lambda(\lambda_i) \lambda_i P(\lambda_i) \Delta\lambda_i. $$
+# 
+# Thus, we can evaluate each passband transmission function on the grid *once*, stack the weights into a response matrix, and compute fluxes for all (passband, SED) pairs with a single matrix product. Transmission is set to 0 outside the tabulated passband range, just like we did by filtering the wavelengths above.
+
+# In[ ]:
+
+
+class SyntheticPhotometry:
+    """
+    Energy- and photon-weighted passband fluxes for stacks of SEDs on a shared wavelength grid.
+    """
+
+    def __init__(self, wls, pbs):
+        """
+        @wls: wavelength grid shared by all SEDs, in m
+        @pbs: list of Passband instances
+
+        Evaluates each passband transmission function on the grid once and
+        stores the energy- and photon-weighted response matrices.
+        """
+
+        self.wls = wls
+        self.pbs = pbs
+
+        dwls = np.gradient(wls)  # quadrature weights; equal to wls[1]-wls[0] on uniform grids
+        self.ptfs = np.zeros((len(pbs), len(wls)))
+        for j, pb in enumerate(pbs):
+            flt = (wls >= pb.ptf_table['wl'][0]) & (wls <= pb.ptf_table['wl'][-1])
+            self.ptfs[j, flt] = cached_ptf(pb, wls[flt])
+
+        self.energy_response = self.ptfs*dwls
+        self.photon_response = self.energy_response*wls/hc
+
+    def __call__(self, seds):
+        """
+        @seds: SED array of shape (len(wls), n_seds) in W/m^3
+
+        Returns a tuple (photon fluxes, energy fluxes), each of shape
+        (n_pbs, n_seds), in photons/m^2 and W/m^2, respectively.
+        """
+
+        return self.photon_response @ seds, self.energy_response @ seds
+
+
+# Let's make sure that we get the same B- and V-band fluxes for the G2 star as we did by hand, and then time the integration of all 4 SEDs through all 3 passbands we have loaded so far:
+
+# In[ ]:
+
+
+photometry = SyntheticPhotometry(wls, [jB, jV, jV1])
+photon_fluxes, energy_fluxes = photometry(seds)
+
+print(f'flux in B-band: {photon_fluxes[0,1]:.3e} photons/m^2 (by hand: {fl_B:.3e} photons/m^2)')
+print(f'flux in V-band: {photon_fluxes[1,1]:.3e} photons/m^2 (by hand: {fl_V:.3e} photons/m^2)')
+
+get_ipython().run_line_magic('timeit', 'photometry(seds)')
+
+
+# The cost of evaluating the passband transmission functions is now paid only once, when we instantiate `SyntheticPhotometry`, and integrating a whole library boils down to a BLAS-backed matrix product. To get a feeling for the scale, let us make up a library of 1000 spectra by randomly rescaling our 4 SEDs (with a seeded generator, so that the library is reproducible) and see how long it takes to integrate them through all passbands:
+
+# In[ ]:
+
+
+rng = np.random.default_rng(seed=42)
+library = seds[:, rng.integers(0, len(spectra), 1000)]*rng.uniform(0.5, 2.0, 1000)
+
+start = time.perf_counter()
+photon_fluxes, energy_fluxes = photometry(library)
+print(f'{library.shape[1]} SEDs through {len(photometry.pbs)} passbands: {time.perf_counter()-start:.3f} s')
+
+
+# ### Composite passbands
+# 
+# When we computed effective wavelengths with `effwl()`, we kept multiplying the filter, QE and atmosphere transmission functions on the fly -- each `ptf()` call evaluates a spline, and `effwl()` evaluates up to 6 of them per line. The product of the response functions *is* a passband in its own right, so it makes more sense to compute it once and treat it as such. Below we build a `Passband` instance from several transmission components: the combined transmission function is tabulated on the union of component wavelengths within their common range, and the passband constructor then takes care of the spline, `ptf_area` and `ptf_photon_area`, just like it did for the atmosphere and the QE curves above. We cache composite passbands by name and by a hash of their component transmission curves, so that asking for the same filter/CCD/atmosphere combination again does not rebuild it, while changing any of the curves does. The combined transmission function has to be written to a `.ptf` file for the passband constructor; by default these go into a temporary directory rather than the current working directory.
+
+# In[ ]:
+
+
+import os
+import tempfile
+
+composite_passbands = {}
+composite_dir = tempfile.mkdtemp(prefix='composite_passbands_')
+
+def get_composite_passband(components, pbset, pbname, cache_dir=None):
+    """
+    @components: list of Passband instances whose transmission functions are multiplied
+    @pbset: passband set of the composite passband
+    @pbname: passband name of the composite passband
+    @cache_dir: directory where the combined transmission function is stored;
+        defaults to a temporary directory
+
+    Returns a Passband instance with the combined transmission function.
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    for pb in components:
+        digest.update(np.ascontiguousarray(pb.ptf_table['wl']).tobytes())
+        digest.update(np.ascontiguousarray(pb.ptf_table['fl']).tobytes())
+    key = (pbset, pbname, digest.hexdigest())
+    if key in composite_passbands:
+        return composite_passbands[key]
+
+    wlmin = max(pb.ptf_table['wl'][0] for pb in components)
+    wlmax = min(pb.ptf_table['wl'][-1] for pb in components)
+    wls = np.unique(np.concatenate([pb.ptf_table['wl'] for pb in components]))
+    wls = wls[(wls >= wlmin) & (wls <= wlmax)]
+
+    ptf = np.prod([cached_ptf(pb, wls) for pb in components], axis=0)
+    ptf_file = os.path.join(cache_dir or composite_dir, f'{pbset}_{pbname}_{key[2][:16]}.ptf')
+    np.savetxt(ptf_file, np.column_stack((1e9*wls, ptf)))
+
+    composite = phoebe.atmospheres.passbands.Passband(
+        ptf=ptf_file,
+        pbset=pbset,
+        pbname=pbname,
+        effwl=1e9*(wls*ptf).sum()/ptf.sum(),
+        wlunits=u.nm,
+        calibrated=True,
+        reference='',
+        version=1.0,
+        comments=' x '.join(f'{pb.pbset}:{pb.pbname}' for pb in components),
+        oversampling=1,
+        ptf_order=3,
+        from_file=False
+    )
+    composite.components = components
+
+    composite_passbands[key] = composite
+    return composite
+
+start = time.perf_counter()
+jB_qe = get_composite_passband([jB, qe], 'Composite', 'B_QE')
+jB_qe_atm = get_composite_passband([jB, qe, atm], 'Composite', 'B_QE_atm')
+jV_qe = get_composite_passband([jV, qe], 'Composite', 'V_QE')
+jV_qe_atm = get_composite_passband([jV, qe, atm], 'Composite', 'V_QE_atm')
+print(f'building composite passbands: {time.perf_counter()-start:.3f} s')
+
+start = time.perf_counter()
+jB_qe_atm = get_composite_passband([jB, qe, atm], 'Composite', 'B_QE_atm')
+print(f'fetching a cached composite passband: {time.perf_counter()-start:.6f} s')
+
+print(f'B x QE x atm photon-weighted area: hc*{jB_qe_atm.ptf_photon_area:.5e}')
+
+
+# Now note that the effective wavelength is just the ratio of the photon-weighted and energy-weighted fluxes, scaled by $hc$:
+# 
+# $$ \lambda_\mathrm{eff} = \frac{\int_\lambda \lambda f_\lambda P(\lambda) d\lambda}{\int_\lambda f_\lambda P(\lambda) d\lambda} = hc \frac{f_P}{f_E}. $$
+# 
+# The filter-only effective wavelength is a special case of a flat SED, $f_\lambda = 1$. Thus, with composite passbands and `SyntheticPhotometry` from above, we get all effective wavelengths for all combinations of passbands and SEDs with every transmission function evaluated exactly once:
+
+# In[ ]:
+
+
+def effwls(wls, pbs, seds):
+    """
+    @wls: wavelength grid shared by all SEDs, in m
+    @pbs: list of Passband instances
+    @seds: SED array of shape (len(wls), n_seds)
+
+    Returns an array of effective wavelengths of shape (n_pbs, n_seds), in m.
+    """
+
+    photon_fluxes, energy_fluxes = SyntheticPhotometry(wls, pbs)(seds)
+    return hc*photon_fluxes/energy_fluxes
+
+for fwls_pb, fseds_pb, pbs in ((fwls_B, fseds_B, (jB, jB_qe, jB_qe_atm)), (fwls_V, fseds_V, (jV, jV_qe, jV_qe_atm))):
+    wleffs = effwls(fwls_pb, pbs, np.column_stack((np.ones_like(fwls_pb), fseds_pb[:,1])))
+    print(f'{pbs[0].pbset.upper()} {pbs[0].pbname.upper()}:')
+    print('-'*43)
+    for label, wleff in zip(('filter only:', 'filter + QE:', 'filter + QE + atm:'), wleffs[:,0]):
+        print(f'{label:26s}wleff = {1e9*wleff:2.2f} nm')
+    for label, wleff in zip(('filter + SED:', 'filter + SED + QE:', 'filter + SED + QE + atm:'), wleffs[:,1]):
+        print(f'{label:26s}wleff = {1e9*wleff:2.2f} nm')
+    print('')
+
+
+# The numbers agree with what we got from `effwl()` above, up to the tiny differences caused by tabulating the product of the splines rather than multiplying the splines themselves.
+# 
+# Because composite passbands are proper `Passband` instances, we can also compute their intensity tables, save them and install them, after which they can be used as any other passband -- in `Inorm()` or as the `passband` of a dataset. Here we compute blackbody intensities only, so we need to provide limb darkening manually. Note that `phoebe.install_passband(..., local=True)` copies the passband file into your local passband directory (see `phoebe.list_passband_directories()`), so we save the file into the temporary directory and uninstall the passband once we are done with it:
+
+# In[ ]:
+
+
+jB_qe_atm.compute_blackbody_response()
+jB_qe_atm.save(os.path.join(composite_dir, 'Composite_B_QE_atm.fits'))
+phoebe.install_passband(os.path.join(composite_dir, 'Composite_B_QE_atm.fits'), local=True)
+
+print(jB_qe_atm.Inorm(Teff=5750, logg=4.5, abun=0, atm='blackbody', ld_func='linear', ld_coeffs=[0.5], photon_weighted=True))
+
+b = phoebe.default_binary()
+b.add_dataset('lc', compute_phases=np.linspace(0, 1, 51), passband='Composite:B_QE_atm')
+b.set_value_all('atm', 'blackbody')
+b.set_value_all('ld_mode', 'manual')
+b.set_value_all('ld_func', 'linear')
+b.set_value_all('ld_coeffs', [0.5])
+b.run_compute()
+b.plot(show=True)
+
+phoebe.uninstall_passband('Composite:B_QE_atm', local=True)
+
+
+# ### Streaming spectra from disk
+# 
+# At the beginning of this tutorial we read all 4 spectra in their entirety, from 90 nm to 4 microns at 0.5 A resolution, only to filter out the few thousand wavelengths that the Johnson passbands actually cover. Moreover, each file contains intensities for all emergent angles, and we only used the last one. This is harmless for 4 spectra, but for a grid of thousands of spectra it means reading (and keeping in memory) orders of magnitude more data than we need. FITS files can be memory-mapped, so we can slice out only the wavelength window covered by our passbands and only the emergent angles we need; only those parts of the file are then actually read from disk. Combined with reading the spectra in chunks, we never hold more than a chunk of passband-trimmed spectra in memory.
+
+# In[ ]:
+
+
+def passband_window(wls, pbs):
+    """
+    @wls: wavelength grid of the spectra, in m
+    @pbs: list of Passband instances
+
+    Returns a slice of the wavelength grid that covers all passbands.
+    """
+
+    wlmin = min(pb.ptf_table['wl'][0] for pb in pbs)
+    wlmax = max(pb.ptf_table['wl'][-1] for pb in pbs)
+    return slice(np.searchsorted(wls, wlmin), np.searchsorted(wls, wlmax, side='right'))
+
+def read_spectrum(filename, window, mus=slice(None)):
+    """
+    @filename: spectrum filename
+    @window: wavelength slice, as returned by passband_window()
+    @mus: emergent angle index or slice; all angles by default
+
+    Returns specific intensities in W/m^3, read from the memory-mapped file.
+    """
+
+    with fits.open(filename, memmap=True) as hdul:
+        return hdul[0].data[mus, window]*1e7  # erg/s/cm^2/A -> W/m^3
+
+def stream_spectra(spectra, window, mus=slice(None), chunk_size=100):
+    """
+    @spectra: list of spectrum filenames
+    @window: wavelength slice, as returned by passband_window()
+    @mus: emergent angle index or slice; all angles by default
+    @chunk_size: number of spectra per chunk
+
+    Yields (filenames, intensities) tuples, where intensities are stacked
+    along the first axis.
+    """
+
+    for i in range(0, len(spectra), chunk_size):
+        chunk = spectra[i:i+chunk_size]
+        yield chunk, np.stack([read_spectrum(filename, window, mus) for filename in chunk])
+
+
+# Let's compare reading the normal intensities in full, as we did at the beginning, with streaming them in chunks of 2 spectra, trimmed to the B and V passbands, and make sure that the fluxes are the same:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+full_seds = np.empty((len(wls), len(spectra)))
+for i, spectrum in enumerate(spectra):
+    with fits.open(spectrum) as hdul:
+        full_seds[:,i] = hdul[0].data[-1,:]*1e7
+full_fluxes, _ = SyntheticPhotometry(wls, [jB, jV])(full_seds)
+print(f'full read:      {time.perf_counter()-start:.3f} s, {full_seds.nbytes/1e6:.2f} MB')
+
+start = time.perf_counter()
+window = passband_window(wls, [jB, jV])
+window_photometry = SyntheticPhotometry(wls[window], [jB, jV])
+streamed_fluxes, peak_chunk = [], 0
+for chunk, sed_chunk in stream_spectra(spectra, window, mus=-1, chunk_size=2):
+    streamed_fluxes.append(window_photometry(sed_chunk.T)[0])
+    peak_chunk = max(peak_chunk, sed_chunk.nbytes)
+streamed_fluxes = np.hstack(streamed_fluxes)
+print(f'streamed read:  {time.perf_counter()-start:.3f} s, {peak_chunk/1e6:.2f} MB per chunk')
+
+assert np.allclose(full_fluxes, streamed_fluxes)
+
+
+# ### Building passband intensity tables
+# 
+# The tables that PHOEBE uses for `Inorm()` are computed in exactly the same way: each model atmosphere spectrum is integrated through the passband, for each emergent angle, and the resulting specific intensities are used to fit limb darkening coefficients. When we create a custom passband, like the composite passbands above, this needs to be done for thousands of spectra, one after another. The spectra are independent of each other, so the work can be distributed over a pool of processes, and the results of each spectrum can be stored to disk as soon as they are available. If the build is interrupted, we simply skip the spectra that have already been checkpointed when we restart it. Checkpoints are stored in a subdirectory keyed by a hash of the passbands, their transmission on the wavelength grid and the emergent angles, so that a build with a different passband set, grid or $\mu$ sampling never picks up stale results. Each worker reads only the passband window of its spectrum, using `read_spectrum()` from above.
+# 
+# Castelli & Kurucz (2004) spectra, like the ones we have been using, tabulate intensities at 37 emergent angles $\mu = \cos \theta$ (the last one is the normal intensity we used for SEDs), and their file names encode atmospheric parameters. For limb darkening, we fit the laws that are linear in their coefficients,
+# 
+# $$ \frac{I(\mu)}{I(1)} = 1 - \sum_k c_k \, g_k(\mu), $$
+# 
+# so that the fit is a simple linear least squares problem that we can solve for all passbands at once.
+
+# In[ ]:
+
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+
+ck2004_mus = np.array([
+    0., 0.001, 0.002, 0.003, 0.005, 0.01, 0.015, 0.02, 0.025, 0.03, 0.035, 0.04,
+    0.045, 0.05, 0.06, 0.07, 0.08, 0.09, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4,
+    0.45, 0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.
+])
+
+# limb darkening basis functions g_k(mu); coefficients are tabulated in this order:
+ld_basis = {
+    'linear': lambda mu: [1-mu],
+    'logarithmic': lambda mu: [1-mu, -mu*np.log(np.where(mu > 0, mu, 1))],
+    'square_root': lambda mu: [1-mu, 1-np.sqrt(mu)],
+    'quadratic': lambda mu: [1-mu, (1-mu)**2],
+}
+
+def ck2004_params(filename):
+    """
+    @filename: spectrum filename, such as T05750G45P00.fits
+
+    Returns a (teff, logg, abun) tuple.
+    """
+
+    name = os.path.basename(filename)
+    return float(name[1:6]), float(name[7:9])/10, float(name[10:12])/10*(-1 if name[9] == 'M' else 1)
+
+worker_tables = {}
+
+def init_table_worker(energy_response, photon_response, window, mus):
+    worker_tables.update(energy_response=energy_response, photon_response=photon_response, window=window, mus=mus)
+
+def integrate_spectrum(filename):
+    """
+    @filename: spectrum filename
+
+    Integrates specific intensities through all passbands and fits limb
+    darkening coefficients. Returns a (results, timings) tuple.
+    """
+
+    timings = {}
+
+    start = time.perf_counter()
+    ints = read_spectrum(filename, worker_tables['window'])
+    timings['spectrum I/O'] = time.perf_counter()-start
+
+    start = time.perf_counter()
+    Imu_energy = ints @ worker_tables['energy_response'].T  # (n_mus, n_pbs)
+    Imu_photon = ints @ worker_tables['photon_response'].T
+    timings['integration'] = time.perf_counter()-start
+
+    start = time.perf_counter()
+    results = {'Imu_energy': Imu_energy, 'Imu_photon': Imu_photon}
+    for weighting, Imu in (('energy', Imu_energy), ('photon', Imu_photon)):
+        results[f'ld_{weighting}'] = np.vstack([
+            np.linalg.lstsq(np.column_stack(ld_basis[law](worker_tables['mus'])), 1-Imu/Imu[-1], rcond=None)[0]
+            for law in ld_basis
+        ])
+    timings['LD fitting'] = time.perf_counter()-start
+
+    return results, timings
+
+def build_intensity_tables(pbs, spectra, wls, checkpoint_dir, mus=ck2004_mus, processes=None):
+    """
+    @pbs: list of Passband instances
+    @spectra: list of spectrum filenames
+    @wls: wavelength grid of the spectra, in m
+    @checkpoint_dir: directory where per-spectrum results are stored, in a
+                     subdirectory keyed by a hash of the passbands, their
+                     responses, the wavelength grid and mus
+    @mus: emergent angles of the spectra
+    @processes: number of worker processes; if 1, spectra are integrated serially
+
+    Returns a dictionary of tables per passband, with keys `axes`, `mus`,
+    `energy_grid`, `photon_grid`, `Imu_energy_grid`, `Imu_photon_grid`,
+    `ld_energy_grid` and `ld_photon_grid`. Passband intensities are stored
+    as log10 values normalized by the passband area; limb darkening
+    coefficients are stored in the order of `ld_basis`.
+    """
+
+    timings = {'spectrum I/O': 0., 'integration': 0., 'LD fitting': 0., 'checkpointing': 0.}
+    start = time.perf_counter()
+
+    window = passband_window(wls, pbs)
+    photometry = SyntheticPhotometry(wls[window], pbs)
+    initargs = (photometry.energy_response, photometry.photon_response, window, mus)
+
+    # checkpoints are only valid for the same passbands, wavelength grid and angles:
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(','.join(f'{pb.pbset}:{pb.pbname}' for pb in pbs).encode())
+    for array in (photometry.energy_response, wls[window], mus):
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    checkpoint_dir = os.path.join(checkpoint_dir, digest.hexdigest())
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    todo = [spectrum for spectrum in spectra if not os.path.exists(os.path.join(checkpoint_dir, os.path.basename(spectrum)+'.npz'))]
+
+    def checkpoint(spectrum, results, spectrum_timings):
+        for stage, t in spectrum_timings.items():
+            timings[stage] += t
+        t = time.perf_counter()
+        filename = os.path.join(checkpoint_dir, os.path.basename(spectrum))
+        np.savez(filename+'.tmp.npz', **results)
+        os.replace(filename+'.tmp.npz', filename+'.npz')
+        timings['checkpointing'] += time.perf_counter()-t
+
+    if processes == 1:
+        init_table_worker(*initargs)
+        for spectrum in todo:
+            checkpoint(spectrum, *integrate_spectrum(spectrum))
+    else:
+        with ProcessPoolExecutor(processes, mp_context=mp.get_context('fork'), initializer=init_table_worker, initargs=initargs) as pool:
+            futures = {pool.submit(integrate_spectrum, spectrum): spectrum for spectrum in todo}
+            for future in as_completed(futures):
+                checkpoint(futures[future], *future.result())
+
+    t = time.perf_counter()
+    params = np.array([ck2004_params(spectrum) for spectrum in spectra])
+    axes = tuple(np.unique(params[:,k]) for k in range(3))
+    indices = tuple(np.searchsorted(axes[k], params[:,k]) for k in range(3))
+    shape = tuple(len(axis) for axis in axes)
+    ncoeffs = sum(len(ld_basis[law](mus)) for law in ld_basis)
+
+    tables = {}
+    for pb in pbs:
+        tables[f'{pb.pbset}:{pb.pbname}'] = {
+            'axes': axes,
+            'mus': mus,
+            'energy_grid': np.full(shape+(1,), np.nan),
+            'photon_grid': np.full(shape+(1,), np.nan),
+            'Imu_energy_grid': np.full(shape+(len(mus), 1), np.nan),
+            'Imu_photon_grid': np.full(shape+(len(mus), 1), np.nan),
+            'ld_energy_grid': np.full(shape+(ncoeffs,), np.nan),
+            'ld_photon_grid': np.full(shape+(ncoeffs,), np.nan),
+        }
+
+    for i, spectrum in enumerate(spectra):
+        index = tuple(idx[i] for idx in indices)
+        with np.load(os.path.join(checkpoint_dir, os.path.basename(spectrum)+'.npz')) as results:
+            for j, pb in enumerate(pbs):
+                table = tables[f'{pb.pbset}:{pb.pbname}']
+                Imu_energy = results['Imu_energy'][:,j]/pb.ptf_area
+                Imu_photon = results['Imu_photon'][:,j]*hc/pb.ptf_photon_area
+                table['Imu_energy_grid'][index] = np.log10(Imu_energy)[:,None]
+                table['Imu_photon_grid'][index] = np.log10(Imu_photon)[:,None]
+                table['energy_grid'][index] = np.log10(Imu_energy[-1])
+                table['photon_grid'][index] = np.log10(Imu_photon[-1])
+                table['ld_energy_grid'][index] = results['ld_energy'][:,j]
+                table['ld_photon_grid'][index] = results['ld_photon'][:,j]
+    timings['table assembly'] = time.perf_counter()-t
+
+    print(f'{len(spectra)-len(todo)} spectra resumed from checkpoints, {len(todo)} spectra integrated')
+    for stage, t in timings.items():
+        print(f'  {stage:16s} {t:8.3f} s')
+    print(f'  {"wall time":16s} {time.perf_counter()-start:8.3f} s')
+
+    return tables
+
+
+# Note that the stage timings are summed over all worker processes, so with more than one process they can add up to more than the wall time. Let's build the tables for the Johnson and composite passbands; to see how resuming works, we first build them from half of the spectra, as if the build was interrupted, and then run the build again for all spectra:
+
+# In[ ]:
+
+
+table_pbs = [jB, jV, jB_qe_atm, jV_qe_atm]
+
+tables = build_intensity_tables(table_pbs, spectra[:2], wls, checkpoint_dir='ck2004_checkpoints')
+tables = build_intensity_tables(table_pbs, spectra, wls, checkpoint_dir='ck2004_checkpoints')
+
+jV_table = tables['Johnson:V']
+index = tuple(np.searchsorted(axis, value) for axis, value in zip(jV_table['axes'], (5750, 4.5, 0.0)))
+print(f"V-band <f_lambda>: {10**jV_table['photon_grid'][index][0]:.5e} photons/m^3")
+print(f"quadratic LD coefficients: {jV_table['ld_energy_grid'][index][-2:]}")
+
+
+# ### Calibration benchmark
+# 
+# Earlier in this tutorial we compared the hand-integrated $\langle f_\lambda \rangle$ with the value that PHOEBE interpolates from its tables, for a single star. Passband tables get regenerated whenever the transmission functions, model atmospheres or the table computation itself change, and every time they do, we want to make sure of two things: that `Inorm()` is still as fast as it was, and that the tabulated intensities still agree with the direct integration of model spectra. So let's turn that single comparison into a benchmark that we can rerun at will:
+# 
+# * for each passband and each of its model atmospheres, `Inorm()` is evaluated in a single batch over all grid vertices where the atmosphere is defined, and the best of several runs is recorded;
+# * for each model spectrum that we have on disk, the photon-weighted normal passband intensity is computed by direct integration (using `build_intensity_tables()` from above) and compared to `Inorm()`.
+# 
+# The results are stored in a json file; when a baseline file already exists, the benchmark reports all passband/atmosphere combinations that became slower or whose deviation from direct integration changed beyond the given tolerances. Atmospheres without intensity tables are reported and skipped, and the check fails if nothing was benchmarked at all or if a combination from the baseline went missing -- otherwise an empty benchmark would trivially pass.
+
+# In[ ]:
+
+
+import json
+
+def calibration_benchmark(pbs, spectra, wls, checkpoint_dir, repeat=3):
+    """
+    @pbs: list of Passband instances
+    @spectra: list of ck2004 spectrum filenames used for direct integration
+    @wls: wavelength grid of the spectra, in m
+    @checkpoint_dir: checkpoint directory for direct integration
+    @repeat: number of batch Inorm() runs; the fastest one is recorded
+
+    Returns a list of benchmark records, one per passband and atmosphere.
+    """
+
+    tables = build_intensity_tables(pbs, spectra, wls, checkpoint_dir)
+    params = np.array([ck2004_params(spectrum) for spectrum in spectra])
+
+    records = []
+    for pb in pbs:
+        table = tables[f'{pb.pbset}:{pb.pbname}']
+        atms = [content.split(':')[0] for content in pb.content if content.endswith(':Inorm')]
+
+        for atm in atms:
+            # grids are read from the phoebe 2.4 passband attributes; analytic
+            # atmospheres such as blackbody do not have them:
+            if not hasattr(pb, f'_{atm}_axes') or not hasattr(pb, f'_{atm}_photon_grid'):
+                print(f'WARNING: {pb.pbset}:{pb.pbname} {atm}: no intensity tables found, not benchmarked')
+                continue
+
+            axes = getattr(pb, f'_{atm}_axes')
+            defined = np.nonzero(~np.isnan(getattr(pb, f'_{atm}_photon_grid')[...,0]))
+            teffs, loggs, abuns = (axis[idx] for axis, idx in zip(axes, defined))
+
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                pb.Inorm(Teff=teffs, logg=loggs, abun=abuns, atm=atm, photon_weighted=True)
+                times.append(time.perf_counter()-start)
+
+            record = {'passband': f'{pb.pbset}:{pb.pbname}', 'atm': atm, 'vertices': len(teffs), 'time': min(times)}
+
+            if atm == 'ck2004':
+                index = tuple(np.searchsorted(table['axes'][k], params[:,k]) for k in range(3))
+                direct = 10**table['photon_grid'][index][:,0]
+                inorms = pb.Inorm(Teff=params[:,0], logg=params[:,1], abun=params[:,2], atm=atm, photon_weighted=True)
+                deviations = inorms/direct-1
+                worst = np.argmax(np.abs(deviations))
+                record.update(spectra=len(spectra), max_deviation=abs(deviations[worst]), mean_deviation=deviations.mean(), worst_spectrum=os.path.basename(spectra[worst]))
+
+            records.append(record)
+
+    return records
+
+def check_calibration(records, baseline_file, time_tolerance=1.5, deviation_tolerance=1e-4, update_baseline=False):
+    """
+    @records: benchmark records, as returned by calibration_benchmark()
+    @baseline_file: json file with baseline records
+    @time_tolerance: maximum allowed ratio of the current and the baseline Inorm() time
+    @deviation_tolerance: maximum allowed change of the maximum relative deviation
+    @update_baseline: if True, records are stored as the new baseline
+
+    Prints the benchmark and returns a list of regressions. An empty set of
+    records, or a baseline passband/atmosphere missing from the records, is
+    reported as a regression as well.
+    """
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = {(record['passband'], record['atm']): record for record in json.load(f)}
+
+    print(f"{'passband':24s} {'atm':10s} {'vertices':>8s} {'Inorm [ms]':>10s} {'us/vertex':>9s} {'max |dev|':>10s}  worst spectrum")
+    regressions = []
+    for record in records:
+        deviation = f"{record['max_deviation']:10.2e}  {record['worst_spectrum']}" if 'max_deviation' in record else ''
+        print(f"{record['passband']:24s} {record['atm']:10s} {record['vertices']:8d} {1e3*record['time']:10.3f} {1e6*record['time']/record['vertices']:9.3f} {deviation}")
+
+        reference = baseline.get((record['passband'], record['atm']))
+        if reference is None:
+            continue
+        if record['time'] > time_tolerance*reference['time']:
+            regressions.append(f"{record['passband']} {record['atm']}: Inorm() time {1e3*reference['time']:.3f} ms -> {1e3*record['time']:.3f} ms")
+        if 'max_deviation' in record and 'max_deviation' in reference and abs(record['max_deviation']-reference['max_deviation']) > deviation_tolerance:
+            regressions.append(f"{record['passband']} {record['atm']}: max deviation {reference['max_deviation']:.2e} -> {record['max_deviation']:.2e}")
+
+    if not records:
+        regressions.append('no passband/atmosphere combinations were benchmarked')
+    for missing in sorted(set(baseline)-{(record['passband'], record['atm']) for record in records}):
+        regressions.append(f'{missing[0]} {missing[1]}: in the baseline but not benchmarked')
+
+    for regression in regressions:
+        print(f'REGRESSION: {regression}')
+
+    if records and (update_baseline or not baseline):
+        with open(baseline_file, 'w') as f:
+            json.dump(records, f, indent=2)
+
+    return regressions
+
+
+# Here we run the benchmark with the 4 spectra we have; for a thorough check, pass the entire ck2004 spectrum grid instead, e.g. `sorted(glob.glob('ck2004/T*.fits'))`. The first run stores the baseline, and any subsequent run -- say, after the passband tables have been regenerated -- is compared against it:
+
+# In[ ]:
+
+
+benchmark_pbs = [jB, jV]
+
+records = calibration_benchmark(benchmark_pbs, spectra, wls, checkpoint_dir='ck2004_checkpoints')
+regressions = check_calibration(records, 'calibration_baseline.json')
+